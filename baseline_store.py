@@ -0,0 +1,120 @@
+import os
+import sqlite3
+from contextlib import closing
+
+# location of the baseline store if no path is given: the UU_BASELINE_STORE environment variable, or this file
+STORE_PATH_ENV = 'UU_BASELINE_STORE'
+DEFAULT_STORE_PATH = os.path.join('bootstraps', 'baselines.sqlite')
+# SQLite treats NULLs in a primary key as distinct, so unseeded baselines are stored with this seed
+UNSEEDED = -1
+# SQLite journal mode of the store: write-ahead logging lets readers and writers work at the same time, but needs the
+# store on a local disk; set UU_BASELINE_JOURNAL_MODE=DELETE for a store on a network filesystem
+JOURNAL_MODE_ENV = 'UU_BASELINE_JOURNAL_MODE'
+DEFAULT_JOURNAL_MODE = 'WAL'
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+# SQLite limits the number of parameters per query
+_MAX_QUERY_KEYS = 900
+
+
+def get_store_path(path=None):
+    """Path of the baseline store: path if given, else $UU_BASELINE_STORE, else bootstraps/baselines.sqlite"""
+    return path if path is not None else os.environ.get(STORE_PATH_ENV, DEFAULT_STORE_PATH)
+
+
+def get_journal_mode():
+    """Journal mode of the baseline store: $UU_BASELINE_JOURNAL_MODE, else WAL"""
+    journal_mode = os.environ.get(JOURNAL_MODE_ENV, DEFAULT_JOURNAL_MODE).upper()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError('{} must be one of {}, not {!r}'.format(JOURNAL_MODE_ENV, ', '.join(JOURNAL_MODES),
+                                                                 journal_mode))
+    return journal_mode
+
+
+def _connect(path):
+    path = get_store_path(path)
+    journal_mode = get_journal_mode()
+    directory = os.path.dirname(path)
+    if directory != '':
+        os.makedirs(directory, exist_ok=True)
+    # wait for other writers instead of failing
+    connection = sqlite3.connect(path, timeout=60)
+    connection.execute('PRAGMA journal_mode=' + journal_mode)
+    connection.execute('CREATE TABLE IF NOT EXISTS baselines ('
+                       'model TEXT NOT NULL, target TEXT NOT NULL, word_count INTEGER NOT NULL, '
+                       'n_samples INTEGER NOT NULL, seed INTEGER NOT NULL, similarity REAL NOT NULL, '
+                       'standard_error REAL NOT NULL, PRIMARY KEY (model, target, word_count, n_samples, seed))')
+    return connection
+
+
+def read_baselines(model, target, word_counts, n_samples, seed=None, path=None, with_errors=False):
+    """Read stored chance similarities for a target word.
+
+    Arguments
+    ---------
+    model: str
+        model key (see models.get_model_key)
+    target: str
+        target word
+    word_counts: list
+        word counts to look up
+    n_samples: int
+        number of random samples the baselines were calculated with
+    seed: int, optional
+        seed the baselines were calculated with (None for unseeded baselines)
+    path: str, optional
+        path of the SQLite file (see get_store_path)
+    with_errors: bool, optional
+        also return the standard error of each baseline (default False)
+
+    Returns
+    -------
+    dict (or (dict, dict) if with_errors)
+        keys for each stored word count with values for average similarity for that word count (and for its standard
+        error). Word counts that are not stored yet are left out.
+    """
+    word_counts = [int(k) for k in word_counts]
+    if len(word_counts) == 0:
+        return ({}, {}) if with_errors else {}
+    key = [model, target, int(n_samples), UNSEEDED if seed is None else int(seed)]
+    rows = []
+    with closing(_connect(path)) as connection:
+        for start in range(0, len(word_counts), _MAX_QUERY_KEYS):
+            batch = word_counts[start:start + _MAX_QUERY_KEYS]
+            rows += connection.execute('SELECT word_count, similarity, standard_error FROM baselines WHERE model = ? '
+                                       'AND target = ? AND n_samples = ? AND seed = ? AND word_count IN ('
+                                       + ', '.join('?' * len(batch)) + ')', key + batch).fetchall()
+    similarities = {k: similarity for k, similarity, _ in rows}
+    if not with_errors:
+        return similarities
+    return similarities, {k: error for k, _, error in rows}
+
+
+def write_baselines(model, target, baselines, standard_errors, n_samples, seed=None, path=None):
+    """Store chance similarities for a target word in one atomic transaction.
+
+    If another process stored a baseline for the same key first, its value is kept.
+
+    Arguments
+    ---------
+    model: str
+        model key (see models.get_model_key)
+    target: str
+        target word
+    baselines: dict
+        keys for each word count with values for average similarity for that word count
+    standard_errors: dict
+        keys for each word count with values for the standard error of its baseline
+    n_samples: int
+        number of random samples the baselines were calculated with
+    seed: int, optional
+        seed the baselines were calculated with (None for unseeded baselines)
+    path: str, optional
+        path of the SQLite file (see get_store_path)
+    """
+    seed = UNSEEDED if seed is None else int(seed)
+    rows = [(model, target, int(k), int(n_samples), seed, float(sim), float(standard_errors[k]))
+            for k, sim in baselines.items()]
+    with closing(_connect(path)) as connection:
+        with connection:
+            connection.executemany('INSERT OR IGNORE INTO baselines (model, target, word_count, n_samples, seed, '
+                                   'similarity, standard_error) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
@@ -0,0 +1,241 @@
+"""Time and memory-profile each stage of the creativity pipeline on synthetic alternative uses data.
+
+By default the Spacy models are replaced by a small random vector table, so the benchmark runs offline. Baselines
+are bootstrapped into a fresh temporary store for every stage, so bootstrap times are cold-cache times.
+
+Example:
+    python benchmark.py --participants 100 1000 --responses 10 --words 3 --targets 1 4 --output bench.json
+
+    # check the analytic chance similarity baselines against Monte Carlo ones on the installed model's vectors
+    python benchmark.py --real-models --participants 100 --check-baselines 10 --output bench.json
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import spacy
+import models
+import baseline_store
+from transform_data_by_response import transform_data_by_response
+from fluency import calc_fluency
+from flexibility_elaboration import (bootstrap_similarity, calc_flexibility_and_elaboration,
+                                     calc_flexibility_and_elaboration_multi_target)
+from originality import calc_originality
+from chance_similarity import chance_similarities, analytic_chance_similarities
+from calc_all_creativity import calc_all_creativity
+
+logger = logging.getLogger(__name__)
+msg_prefix = '[BENCH] '
+
+
+def make_synthetic_nlp(vocab_size=5000, vector_width=50, seed=0):
+    """Blank English Spacy model with random vectors for vocab_size made-up words (plus English stop words)
+
+    Returns
+    -------
+    (Spacy model, list of the made-up words)
+    """
+    rng = np.random.default_rng(seed)
+    nlp = spacy.blank('en')
+    nlp.vocab.reset_vectors(width=vector_width)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    words = list(dict.fromkeys(''.join(rng.choice(letters, size=rng.integers(3, 10)))
+                               for _ in range(vocab_size)))
+    for word in words + sorted(nlp.Defaults.stop_words):
+        nlp.vocab.set_vector(word, rng.normal(size=vector_width).astype(np.float32))
+    nlp.meta['name'] = 'synthetic_{}x{}'.format(len(words), vector_width)
+    return nlp, words
+
+
+def model_words(nlp, vocab_size=5000):
+    """Up to vocab_size alphabetic non-stop words that have a vector in a real Spacy model"""
+    words = []
+    for key in nlp.vocab.vectors.keys():
+        lexeme = nlp.vocab[key]
+        if lexeme.is_alpha and lexeme.is_lower and not lexeme.is_stop:
+            words.append(lexeme.text)
+            if len(words) == vocab_size:
+                break
+    return words
+
+
+def make_synthetic_dataset(words, n_participants, responses_per_participant, words_per_response, n_targets,
+                           seed=0):
+    """Raw alternative uses data with one row per participant (columns 'ID', 'response', and 'target_word')
+
+    Each response is a few random words, with a stop word mixed in every other response. Responses per participant
+    and words per response vary around the given means.
+    """
+    rng = np.random.default_rng(seed)
+    # numpy strings are not accepted by Spacy, so convert sampled words to str
+    targets = [str(word) for word in rng.choice(words, size=n_targets, replace=False)]
+    rows = []
+    for participant in range(n_participants):
+        n_responses = max(1, int(rng.poisson(responses_per_participant)))
+        responses = []
+        for i in range(n_responses):
+            response = [str(word) for word in rng.choice(words, size=max(1, int(rng.poisson(words_per_response))))]
+            if i % 2 == 0:
+                response.insert(0, 'the')
+            responses.append(' '.join(response))
+        rows.append({'ID': 'P{}'.format(participant), 'response': ' / '.join(responses),
+                     'target_word': targets[participant % n_targets]})
+    return pd.DataFrame(rows)
+
+
+def _measure(stage, function, profile_memory):
+    """Run function once and return (its result, a dict with the stage's seconds and peak traced memory in MB)"""
+    store_dir = tempfile.mkdtemp()
+    old_store_path = os.environ.get(baseline_store.STORE_PATH_ENV)
+    os.environ[baseline_store.STORE_PATH_ENV] = os.path.join(store_dir, 'baselines.sqlite')
+    if profile_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function()
+    finally:
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 1e6 if profile_memory else None
+        if profile_memory:
+            tracemalloc.stop()
+        if old_store_path is None:
+            del os.environ[baseline_store.STORE_PATH_ENV]
+        else:
+            os.environ[baseline_store.STORE_PATH_ENV] = old_store_path
+        shutil.rmtree(store_dir, ignore_errors=True)
+    logger.info(msg_prefix + '%s: %.3fs', stage, seconds)
+    return result, {'stage': stage, 'seconds': seconds, 'peak_memory_mb': peak}
+
+
+def run_benchmark(nlp, words, n_participants, responses_per_participant, words_per_response, n_targets,
+                  n_samples=10000, profile_memory=True, seed=0):
+    """Time each pipeline stage on one synthetic dataset
+
+    Returns
+    -------
+    list
+        one dict per stage with the dataset parameters, 'stage', 'seconds', and 'peak_memory_mb'
+    """
+    params = {'participants': n_participants, 'responses_per_participant': responses_per_participant,
+              'words_per_response': words_per_response, 'targets': n_targets}
+    raw_data = make_synthetic_dataset(words, n_participants, responses_per_participant, words_per_response,
+                                      n_targets, seed)
+    data_by_response, result = _measure(
+        'transform_data_by_response',
+        lambda: transform_data_by_response(raw_data, delimiter='/', random_state=seed), profile_memory)
+    results = [result]
+    data_by_response['target_word'] = data_by_response.ID.map(raw_data.set_index('ID').target_word).values
+    params['responses'] = len(data_by_response)
+    responses = list(data_by_response.response)
+    targets = list(data_by_response.target_word)
+    first_target = targets[0]
+    max_elaboration = int(data_by_response.response.str.split().str.len().max())
+
+    stages = [
+        ('calc_fluency', lambda: calc_fluency(data_by_response, nlp)),
+        ('bootstrap_similarity',
+         lambda: bootstrap_similarity(np.arange(1, max_elaboration + 1), first_target, n_samples=n_samples)),
+        ('calc_originality', lambda: calc_originality(data_by_response.response, random_state=seed)),
+    ]
+    if n_targets == 1:
+        stages += [
+            ('calc_flexibility_and_elaboration',
+             lambda: calc_flexibility_and_elaboration(responses, first_target, nlp)),
+            ('calc_all_creativity', lambda: calc_all_creativity(data_by_response, first_target, nlp)),
+        ]
+    else:
+        stages += [
+            ('calc_flexibility_and_elaboration_multi_target',
+             lambda: calc_flexibility_and_elaboration_multi_target(responses, targets, nlp)),
+            ('calc_all_creativity', lambda: calc_all_creativity(data_by_response, nlp=nlp, multi_target=True)),
+        ]
+    for stage, function in stages:
+        results.append(_measure(stage, function, profile_memory)[1])
+    return [dict(params, **result) for result in results]
+
+
+def check_baselines(model_name, targets, max_elaboration, n_samples=40000, seed=0):
+    """Compare analytic chance similarity baselines with Monte Carlo ones on a model's vectors
+
+    Returns
+    -------
+    list
+        one dict per target and word count with the analytic baseline and its second-order term, the Monte Carlo
+        baseline and its standard error, and whether the difference is within 1.96 standard errors (i.e. whether the
+        analytic baseline is inside the Monte Carlo 95% confidence interval)
+    """
+    nlp = models.get_nlp(model_name, vectors_only=True)
+    vocab_vectors = models.get_vocab_vectors(model_name)
+    moments = models.get_vocab_moments(model_name)
+    word_counts = range(1, max_elaboration + 1)
+    results = []
+    for target in targets:
+        target_vector = nlp(target).vector
+        analytic, second_order, _ = analytic_chance_similarities(moments, target_vector, word_counts)
+        monte_carlo, standard_errors = chance_similarities(vocab_vectors, target_vector, word_counts, n_samples,
+                                                           seed, return_errors=True)
+        for k in word_counts:
+            difference = analytic[k] - monte_carlo[k]
+            results.append({'target': target, 'word_count': k, 'analytic': analytic[k],
+                            'second_order': second_order[k], 'monte_carlo': monte_carlo[k],
+                            'monte_carlo_standard_error': standard_errors[k], 'difference': difference,
+                            'within_interval': bool(abs(difference) <= 1.96 * standard_errors[k])})
+        logger.info(msg_prefix + 'Baselines for %s: largest analytic - Monte Carlo difference %.4f', target,
+                    max(abs(row['difference']) for row in results if row['target'] == target))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the creativity pipeline on synthetic data.')
+    parser.add_argument('--participants', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--responses', type=int, nargs='+', default=[10], help='mean responses per participant')
+    parser.add_argument('--words', type=int, nargs='+', default=[3], help='mean words per response')
+    parser.add_argument('--targets', type=int, nargs='+', default=[1], help='number of target words')
+    parser.add_argument('--n-samples', type=int, default=10000, help='bootstrap samples per word count')
+    parser.add_argument('--vocab-size', type=int, default=5000, help='words in the synthetic vector table')
+    parser.add_argument('--vector-width', type=int, default=50, help='width of the synthetic vectors')
+    parser.add_argument('--real-models', action='store_true',
+                        help='use the installed Spacy models instead of a synthetic vector table')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc memory profiling')
+    parser.add_argument('--check-baselines', type=int, default=0, metavar='N_TARGETS',
+                        help='compare analytic and Monte Carlo baselines for this many random target words')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write results to')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args.real_models:
+        nlp = models.get_nlp(models.DEFAULT_MODEL, vectors_only=True)
+        words = model_words(nlp, args.vocab_size)
+    else:
+        nlp, words = make_synthetic_nlp(args.vocab_size, args.vector_width, args.seed)
+        models.register_nlp(models.DEFAULT_MODEL, nlp)
+        models.register_nlp(models.BASELINE_MODEL, nlp)
+
+    results = []
+    for n_participants, n_responses, n_words, n_targets in itertools.product(
+            args.participants, args.responses, args.words, args.targets):
+        logger.info(msg_prefix + '%d participants, %d responses, %d words, %d targets',
+                    n_participants, n_responses, n_words, n_targets)
+        results += run_benchmark(nlp, words, n_participants, n_responses, n_words, n_targets, args.n_samples,
+                                 not args.no_memory, args.seed)
+    output = {'real_models': args.real_models, 'n_samples': args.n_samples, 'results': results}
+    if args.check_baselines > 0:
+        targets = [str(word) for word in np.random.default_rng(args.seed).choice(words, size=args.check_baselines,
+                                                                                 replace=False)]
+        output['baseline_check'] = check_baselines(models.BASELINE_MODEL, targets, max(args.words) * 3,
+                                                   seed=args.seed)
+    with open(args.output, 'w') as output_file:
+        json.dump(output, output_file, indent=2)
+    logger.info(msg_prefix + 'Wrote results to %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
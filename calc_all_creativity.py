@@ -1,15 +1,50 @@
+import logging
 import pandas as pd
-import spacy
 import numpy as np
 from transform_data_by_response import transform_data_by_response
 from fluency import calc_fluency
 from flexibility_elaboration import calc_flexibility_and_elaboration, calc_flexibility_and_elaboration_multi_target
-from originality import calc_originality
+from originality import calc_originality, score_originality
+from models import DEFAULT_MODEL, get_nlp, nlp_model_key
+from preprocess import preprocess_responses, subset_records
+import instrumentation
+from feature_store import (response_key, participant_key, read_response_features, write_response_features,
+                           read_fluency, write_fluency)
 
+logger = logging.getLogger(__name__)
 
-def z_score(array):
-    """Convert array of numbers to Z scores"""
-    return (array - np.nanmean(array)) / np.std(array)
+
+# response-level metrics that are z scored and averaged by subject
+RESPONSE_METRICS = ['elaboration', 'flexibility', 'originality']
+
+
+def z_score(array, mean=None, std=None):
+    """Convert array of numbers to Z scores, using the array's own mean and standard deviation unless given"""
+    mean = np.nanmean(array) if mean is None else mean
+    std = np.std(array) if std is None else std
+    return (array - mean) / std
+
+
+def aggregate_by_subject(by_response_df, variables, id_column='ID'):
+    """Calculate the mean score by subject for several variables in one grouped pass
+
+    Missing values are ignored, as with np.nanmean (subjects with only missing values get NaN).
+
+    Arguments
+    ---------
+    by_response_df: pandas dataframe
+        input dataframe (one row per response, multiple responses per subject, column id_column has subject IDs)
+    variables: list
+        column names of data to average in by_response_df
+    id_column: str, optional
+        column with subject IDs (default 'ID')
+
+    Returns
+    -------
+    pandas dataframe
+        one row per subject, in order of first appearance, with column id_column and the mean of each variable
+    """
+    return by_response_df.groupby(id_column, sort=False)[list(variables)].mean().reset_index()
 
 
 def mean_by_subject(by_subject_df, by_response_df, variable):
@@ -29,14 +64,172 @@ def mean_by_subject(by_subject_df, by_response_df, variable):
     pandas series
         new column to add to by_subject_df containing the mean of 'variable' by subject
     """
-    return by_subject_df.apply(
-        lambda row:
-            np.nanmean(by_response_df.loc[by_response_df.ID == row.ID, variable]),
-        axis=1
-    )
+    return by_subject_df.ID.map(by_response_df.groupby('ID')[variable].mean())
+
+
+def _format_prefix(output_prefix):
+    """make sure prefix ends in _ if there is one"""
+    return output_prefix if (output_prefix.endswith('_') | (output_prefix == '')) else output_prefix + '_'
+
 
+def _score_responses_incremental(data_by_response, target_word, nlp, multi_target, n_jobs, feature_store,
+                                 baseline_method):
+    """Fluency, clean_response, elaboration, and flexibility, reusing what is in the feature store
 
-def calc_all_creativity(data_by_response, target_word=None, nlp=None, output_prefix='', multi_target=False):
+    Only responses that are not stored yet (for their target word and model) are parsed and scored, and fluency is
+    only recalculated for participants whose list of responses changed.
+    """
+    model_key = nlp_model_key(nlp)
+    responses = ['' if not isinstance(r, str) else r for r in data_by_response.response]
+    targets = list(data_by_response.target_word) if multi_target else [target_word] * len(responses)
+    # stored flexibility depends on how chance similarity was calculated
+    feature_model_key = model_key if baseline_method == 'bootstrap' else '{}/{}'.format(model_key, baseline_method)
+    keys = [response_key(response, target, feature_model_key) for response, target in zip(responses, targets)]
+    features = read_response_features(keys, feature_store)
+    # score each new response once, even if several participants gave it
+    first_new_rows = {}
+    for i, key in enumerate(keys):
+        if key not in features:
+            first_new_rows.setdefault(key, i)
+    new_rows = list(first_new_rows.values())
+    instrumentation.count('feature_cache_hits', len(keys) - len(new_rows))
+    instrumentation.count('feature_cache_misses', len(new_rows))
+    logger.info('Reusing stored features for %d responses, scoring %d new responses',
+                len(keys) - len(new_rows), len(new_rows))
+    if len(new_rows) > 0:
+        new_responses = [responses[i] for i in new_rows]
+        new_records = preprocess_responses(new_responses, nlp)
+        new_flexibility = calc_flexibility_and_elaboration_multi_target(
+            new_responses, [targets[i] for i in new_rows], nlp, records=new_records,
+            baseline_method=baseline_method).flexibility.values
+        new_features = {keys[i]: (new_records['clean_response'][j], new_records['elaboration'][j],
+                                  new_records['vectors'][j], new_records['lower_vectors'][j], new_flexibility[j])
+                        for j, i in enumerate(new_rows)}
+        write_response_features(new_features, feature_store)
+        features.update(new_features)
+    records = {'clean_response': [features[key][0] for key in keys],
+               'elaboration': np.array([features[key][1] for key in keys], dtype=np.float64),
+               'vectors': np.array([features[key][2] for key in keys], dtype=np.float32),
+               'lower_vectors': np.array([features[key][3] for key in keys], dtype=np.float32)}
+
+    results_df = pd.DataFrame({'responseID': data_by_response.responseID, 'ID': data_by_response.ID})
+    rows_by_id = data_by_response.groupby('ID', sort=False).indices
+    participant_keys = {ID: participant_key([keys[i] for i in rows], model_key) for ID, rows in rows_by_id.items()}
+    fluency_by_key = read_fluency(participant_keys.values(), feature_store)
+    changed_ids = [ID for ID, key in participant_keys.items() if key not in fluency_by_key]
+    instrumentation.count('fluency_cache_hits', len(participant_keys) - len(changed_ids))
+    instrumentation.count('fluency_cache_misses', len(changed_ids))
+    logger.info('Reusing stored fluency for %d participants, scoring %d new or changed participants',
+                len(participant_keys) - len(changed_ids), len(changed_ids))
+    if len(changed_ids) > 0:
+        changed_rows = np.concatenate([rows_by_id[ID] for ID in changed_ids])
+        changed_fluency = calc_fluency(data_by_response.iloc[changed_rows], nlp,
+                                       records=subset_records(records, changed_rows), n_jobs=n_jobs)
+        new_fluency = {participant_keys[ID]: fluency
+                       for ID, fluency in zip(data_by_response.ID.iloc[changed_rows], changed_fluency)}
+        write_fluency(new_fluency, feature_store)
+        fluency_by_key.update(new_fluency)
+    results_df['fluency'] = [fluency_by_key.get(participant_keys.get(ID), np.nan) for ID in data_by_response.ID]
+    results_df['clean_response'] = records['clean_response']
+    results_df['elaboration'] = records['elaboration']
+    results_df['flexibility'] = [features[key][4] for key in keys]
+    return results_df
+
+
+def score_responses(data_by_response, target_word=None, nlp=None, multi_target=False, n_jobs=1,
+                    originality_model=None, feature_store=None, baseline_method='bootstrap'):
+    """Calculate raw fluency, elaboration, flexibility, and originality for each response
+
+    Arguments are the same as for calc_all_creativity.
+
+    Returns
+    -------
+    pandas dataframe
+        one row per response with columns responseID, ID, fluency, clean_response, elaboration, flexibility, and
+        originality
+    """
+    if nlp is None:
+        nlp = get_nlp(DEFAULT_MODEL, vectors_only=True)
+
+    if feature_store is not None:
+        with instrumentation.stage('incremental features'):
+            results_df = _score_responses_incremental(data_by_response, target_word, nlp, multi_target, n_jobs,
+                                                      feature_store, baseline_method)
+    else:
+        results_df = pd.DataFrame({'responseID': data_by_response.responseID, 'ID': data_by_response.ID})
+        with instrumentation.stage('preprocess'):
+            records = preprocess_responses(list(data_by_response.response), nlp)
+        with instrumentation.stage('fluency'):
+            results_df['fluency'] = calc_fluency(data_by_response, nlp, records=records, n_jobs=n_jobs)
+        with instrumentation.stage('elaboration and flexibility'):
+            flexibility = \
+                calc_flexibility_and_elaboration(list(data_by_response.response), target_word, nlp,
+                                                 records=records, baseline_method=baseline_method) \
+                if not multi_target else \
+                calc_flexibility_and_elaboration_multi_target(list(data_by_response.response),
+                                                              list(data_by_response.target_word),
+                                                              nlp, records=records, baseline_method=baseline_method)
+        for column in ['clean_response', 'elaboration', 'flexibility']:
+            results_df[column] = flexibility[column].values
+    with instrumentation.stage('originality'):
+        results_df['originality'] = calc_originality(data_by_response.response) if originality_model is None else \
+            score_originality(originality_model, data_by_response.response)
+    return results_df
+
+
+def add_z_scores(results_df, stats=None):
+    """Add z scored elaboration, flexibility, and originality columns (z_elaboration etc.) to results_df
+
+    stats: dict, optional
+        keys for each metric with (mean, standard deviation) to z score with. If not provided, results_df's own mean
+        and standard deviation are used.
+    """
+    for metric in RESPONSE_METRICS:
+        mean, std = (None, None) if stats is None else stats[metric]
+        results_df['z_' + metric] = z_score(results_df[metric], mean, std)
+    return results_df
+
+
+def summarize_by_subject(results_df, output_prefix='', fluency_stats=None):
+    """Average z scored response metrics by subject, z score fluency, and calculate creativity_score
+
+    Arguments
+    ---------
+    results_df: pandas dataframe
+        output from score_responses with z scores added by add_z_scores
+    output_prefix: str, optional
+        prefix to use for column names in output. (default no prefix)
+    fluency_stats: tuple, optional
+        (mean, standard deviation) of subject fluency to z score with. If not provided, the mean and standard
+        deviation of the subjects in results_df are used.
+
+    Returns
+    -------
+    pandas dataframe
+        one row per subject (see calc_all_creativity)
+    """
+    output_prefix = _format_prefix(output_prefix)
+    elab_out_name, flex_out_name, orig_out_name, flue_out_name, creativity_out_name = [
+        output_prefix + n for n in ['elaboration', 'flexibility', 'originality', 'fluency',
+                                    'creativity_score']]
+    subject_columns = {'z_elaboration': elab_out_name + '_z', 'elaboration': elab_out_name + '_raw',
+                       'z_flexibility': flex_out_name + '_z', 'flexibility': flex_out_name + '_raw',
+                       'z_originality': orig_out_name + '_z', 'originality': orig_out_name + '_raw',
+                       'fluency': flue_out_name + '_raw'}
+    results_by_subject = aggregate_by_subject(results_df, subject_columns.keys()).rename(columns=subject_columns)
+    mean, std = (None, None) if fluency_stats is None else fluency_stats
+    results_by_subject[flue_out_name + '_z'] = z_score(results_by_subject[flue_out_name + '_raw'], mean, std)
+
+    results_by_subject[creativity_out_name] = results_by_subject[[elab_out_name + '_z',
+                                                                  flex_out_name + '_z',
+                                                                  orig_out_name + '_z',
+                                                                  flue_out_name + '_z']].mean(axis=1)
+    return results_by_subject
+
+
+def calc_all_creativity(data_by_response, target_word=None, nlp=None, output_prefix='', multi_target=False,
+                        n_jobs=1, originality_model=None, feature_store=None, progress_callback=None,
+                        baseline_method='bootstrap'):
     """ Calculate fluency, flexibility, elaboration, and originality. Then Z score and calculate creativity score
 
     This function calls fluency.py, flexibility_elaboration.py, and originality.py to calculate the four
@@ -54,11 +247,29 @@ def calc_all_creativity(data_by_response, target_word=None, nlp=None, output_pre
         task's target word, used to calculate flexibility in flexibility_elaboration.py.
         Should be string if multi_target is False, and list if multi_target is True
     nlp: Spacy model, optional
-        output from spacy.load(). If not provided, will load 'en_vectors_web_lg'.
+        output from spacy.load(). If not provided, will load 'en_vectors_web_lg' (with its parsers disabled) through
+        models.py, so it is only loaded once per process.
     output_prefix: str, optional
         prefix to use for column names in output. (default no prefix)
     multi_target: bool, optional
         True if responses use different target words, False if all responses use the same target word. (default False)
+    n_jobs: int, optional
+        number of worker processes used to calculate fluency, -1 to use all CPUs (default 1)
+    originality_model: dict, optional
+        output from originality.fit_originality (or load_originality_model) to score originality against a fixed
+        reference norm. If not provided, clusters are fitted on data_by_response.
+    feature_store: str, optional
+        path of a SQLite feature store (see feature_store.py). If provided, per-response features are only calculated
+        for responses that are not in the store yet, fluency is only recalculated for participants whose responses
+        changed, and new results are added to the store. Z scores and originality are always recalculated.
+    progress_callback: function, optional
+        called at the start and end of each stage and with progress within stages (see
+        instrumentation.start_report). Progress is also logged with the logging module.
+    baseline_method: str, optional
+        how to calculate the chance similarity that flexibility is corrected for: 'bootstrap' (fixed number of random
+        samples, stored in the baseline store), 'adaptive' (sample until precise enough), or 'analytic' (from the
+        vocabulary's mean and covariance, without sampling). See flexibility_elaboration.bootstrap_similarity.
+        (default 'bootstrap')
 
     Returns
     -------
@@ -69,6 +280,8 @@ def calc_all_creativity(data_by_response, target_word=None, nlp=None, output_pre
         results_by_response: pandas dataframe
             dataframe with one row per response containing cleaned responses, and both raw and z scored originality,
             flexibility, and originality
+        timing_report: dict
+            seconds per stage and counters such as docs parsed and cache hits (see instrumentation.get_report)
     }
     """
     if (target_word is None) & (not multi_target):
@@ -76,50 +289,17 @@ def calc_all_creativity(data_by_response, target_word=None, nlp=None, output_pre
             "If the task has a single target word, provide a target_word argument. If there are multiple target words, "
             + "set the multi_target argument to True and make sure data_by_response has a 'target_word' column")
 
-    if nlp is None:
-        print('Loading spacy model: en_vectors_web_lg')
-        nlp = spacy.load('en_vectors_web_lg')
-    # make sure prefix ends in _ if there is one
-    if not (output_prefix.endswith('_') | (output_prefix == '')):
-        output_prefix = output_prefix + '_'
-
-    results_df = pd.DataFrame({'responseID': data_by_response.responseID, 'ID': data_by_response.ID})
-    print('Calculating fluency using fluency.py')
-    results_df['fluency'] = calc_fluency(data_by_response, nlp)
-    print('Calculating elaboration and flexibility using flexibility_elaboration.py')
-    results_df[['clean_response', 'elaboration', 'flexibility']] = \
-        calc_flexibility_and_elaboration(list(data_by_response.response), target_word, nlp) if not multi_target else \
-        calc_flexibility_and_elaboration_multi_target(list(data_by_response.response),
-                                                      list(data_by_response.target_word),
-                                                      nlp)
-    print('Calculating originality using originality.py')
-    results_df['originality'] = calc_originality(data_by_response.response)
-
-    print('Z-scoring and concatenating results')
-    results_df['z_elaboration'] = z_score(results_df.elaboration)
-    results_df['z_flexibility'] = z_score(results_df.flexibility)
-    results_df['z_originality'] = z_score(results_df.originality)
-
-    results_by_subject = pd.DataFrame({'ID': results_df.ID.unique()})
-    elab_out_name, flex_out_name, orig_out_name, flue_out_name, creativity_out_name = [
-        output_prefix + n for n in ['elaboration', 'flexibility', 'originality', 'fluency',
-                                    'creativity_score']]
-    results_by_subject[elab_out_name + '_z'] = mean_by_subject(results_by_subject, results_df, 'z_elaboration')
-    results_by_subject[elab_out_name + '_raw'] = mean_by_subject(results_by_subject, results_df, 'elaboration')
-    results_by_subject[flex_out_name + '_z'] = mean_by_subject(results_by_subject, results_df, 'z_flexibility')
-    results_by_subject[flex_out_name + '_raw'] = mean_by_subject(results_by_subject, results_df, 'flexibility')
-    results_by_subject[orig_out_name + '_z'] = mean_by_subject(results_by_subject, results_df, 'z_originality')
-    results_by_subject[orig_out_name + '_raw'] = mean_by_subject(results_by_subject, results_df, 'originality')
-
-    results_by_subject[flue_out_name + '_raw'] = mean_by_subject(results_by_subject, results_df, 'fluency')
-    results_by_subject[flue_out_name + '_z'] = z_score(results_by_subject[flue_out_name + '_raw'])
+    instrumentation.start_report(progress_callback)
+    results_df = score_responses(data_by_response, target_word, nlp, multi_target, n_jobs, originality_model,
+                                 feature_store, baseline_method)
 
-    results_by_subject[creativity_out_name] = results_by_subject[[elab_out_name + '_z',
-                                                                  flex_out_name + '_z',
-                                                                  orig_out_name + '_z',
-                                                                  flue_out_name + '_z']].mean(axis=1)
+    with instrumentation.stage('z scores and subject summary'):
+        add_z_scores(results_df)
+        results_by_subject = summarize_by_subject(results_df, output_prefix)
 
-    print('Done calculating all creativity metrics\n')
+    timing_report = instrumentation.get_report()
+    logger.info('Done calculating all creativity metrics in %.2fs', timing_report['total_seconds'])
 
-    return {'results_by_subject': results_by_subject, 'results_by_response': results_df}
+    return {'results_by_subject': results_by_subject, 'results_by_response': results_df,
+            'timing_report': timing_report}
 
@@ -0,0 +1,332 @@
+import numpy as np
+import instrumentation
+
+
+def extract_vocab_vectors(nlp, exclude_stops=True):
+    """Get the vector table of a Spacy model with the row of every (non-stop) word in its vocabulary.
+
+    Many keys can share a row of the vector table, so the table itself is kept as is (without copying) and each key
+    gets an entry in an index of rows. Words are drawn by position in that index, so they are drawn with the same
+    probabilities as sampling from nlp.vocab.vectors.keys().
+
+    Arguments
+    ---------
+    nlp: Spacy model
+        model with word vectors, e.g. output from spacy.load('en_core_web_md')
+    exclude_stops: bool, optional
+        leave out stop words (default True)
+
+    Returns
+    -------
+    {
+        data: numpy array
+            float32 vector table (unique vectors)
+        rows: numpy array
+            int32 row of data for each word
+    }
+    """
+    vectors = nlp.vocab.vectors
+    rows = [row for key, row in vectors.key2row.items()
+            if not (exclude_stops and nlp.vocab[key].is_stop)]
+    return {'data': np.asarray(vectors.data, dtype=np.float32), 'rows': np.array(rows, dtype=np.int32)}
+
+
+def _word_vectors(vocab_vectors, indices):
+    """Vectors of the words at positions indices of vocab_vectors['rows']"""
+    return vocab_vectors['data'][vocab_vectors['rows'][indices]]
+
+
+def _sample_indices(n_words, sample_size, n_samples, rng):
+    """Draw n_samples rows of sample_size distinct word indices"""
+    indices = rng.integers(0, n_words, size=(n_samples, sample_size))
+    # redraw any row that picked the same word twice, so each row is a sample without replacement
+    while True:
+        sorted_indices = np.sort(indices, axis=1)
+        repeats = np.any(sorted_indices[:, 1:] == sorted_indices[:, :-1], axis=1)
+        if not repeats.any():
+            return indices
+        indices[repeats] = rng.integers(0, n_words, size=(int(repeats.sum()), sample_size))
+
+
+def _cosine_to_target(summed_vectors, target_vector):
+    """Cosine similarity between each summed vector (last axis) and the target. Zero vectors get similarity 0."""
+    norms = np.linalg.norm(summed_vectors, axis=-1) * np.linalg.norm(target_vector)
+    dots = summed_vectors @ target_vector
+    return np.divide(dots, norms, out=np.zeros_like(dots), where=norms != 0)
+
+
+def sample_chance_similarity(vocab_vectors, target_vector, sample_size, n_samples=10000, rng=None):
+    """Similarity to the target of the mean vector of sample_size random words, for n_samples draws.
+
+    Arguments
+    ---------
+    vocab_vectors: dict
+        word vectors from extract_vocab_vectors
+    target_vector: numpy array
+        vector of the target word
+    sample_size: int
+        number of words per draw
+    n_samples: int, optional
+        number of draws (default 10,000)
+    rng: numpy Generator, optional
+        random number generator. If not provided, an unseeded one is used.
+
+    Returns
+    -------
+    numpy array
+        one cosine similarity per draw
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    indices = _sample_indices(len(vocab_vectors['rows']), int(sample_size), n_samples, rng)
+    instrumentation.count('bootstrap_samples', n_samples)
+    # cosine similarity of the mean vector is the same as that of the summed vector
+    return _cosine_to_target(_word_vectors(vocab_vectors, indices).sum(axis=1), target_vector)
+
+
+def _count_bin(word_count):
+    """Bin of a word count: bin b holds word counts 2 ** (b - 1) + 1 to 2 ** b (bin 0 holds word count 1)"""
+    return (int(word_count) - 1).bit_length()
+
+
+def chance_similarities(vocab_vectors, target_vector, word_counts, n_samples=10000, seed=None, chunk_size=1000,
+                        return_errors=False):
+    """Calculate the average chance similarity to the target for several word counts at once.
+
+    Word counts are binned by powers of two (1, 2, 3-4, 5-8, 9-16, ...). For each bin, n_samples samples of as many
+    distinct random words as the bin's largest word count are drawn. The first k words of each sample are a random
+    sample of k words, so a cumulative sum over each sample gives the summed vector for every word count in the bin
+    in one pass. With a seed, each bin draws from its own random stream, so the baseline for a word count only
+    depends on the seed and the word count, not on which other word counts are calculated in the same call.
+
+    Arguments
+    ---------
+    vocab_vectors: dict
+        word vectors from extract_vocab_vectors
+    target_vector: numpy array
+        vector of the target word
+    word_counts: list
+        positive word counts to calculate chance similarity for
+    n_samples: int, optional
+        number of random samples per word count (default 10,000)
+    seed: int, optional
+        seed for the random number generator, for reproducible baselines
+    chunk_size: int, optional
+        number of samples processed at a time, to limit memory use (default 1,000)
+    return_errors: bool, optional
+        also return the standard error of each average (default False)
+
+    Returns
+    -------
+    dict (or (dict, dict) if return_errors)
+        keys for each word count with values for average similarity for that word count (and for its standard error)
+    """
+    word_counts = sorted({int(k) for k in word_counts})
+    target_vector = np.asarray(target_vector, dtype=np.float32)
+    unseeded_rng = np.random.default_rng() if seed is None else None
+    instrumentation.count('bootstrap_samples', n_samples * len(word_counts))
+    similarities = {}
+    standard_errors = {}
+    for count_bin in sorted({_count_bin(k) for k in word_counts}):
+        bin_counts = [k for k in word_counts if _count_bin(k) == count_bin]
+        # draw up to the bin's largest word count, whichever word counts of the bin are requested
+        drawn_counts = bin_counts if bin_counts[-1] == 2 ** count_bin else bin_counts + [2 ** count_bin]
+        rng = unseeded_rng if seed is None else np.random.default_rng(np.random.SeedSequence([seed, count_bin]))
+        sim_totals = np.zeros(len(drawn_counts))
+        squared_totals = np.zeros(len(drawn_counts))
+        for start in range(0, n_samples, chunk_size):
+            n_chunk = min(chunk_size, n_samples - start)
+            chunk_similarities = _prefix_similarities(vocab_vectors, target_vector, drawn_counts, n_chunk, rng)
+            sim_totals += chunk_similarities.sum(axis=0)
+            squared_totals += np.square(chunk_similarities).sum(axis=0)
+        means, errors = _mean_and_standard_error(sim_totals, squared_totals, n_samples)
+        similarities.update(zip(bin_counts, means[:len(bin_counts)]))
+        standard_errors.update(zip(bin_counts, errors[:len(bin_counts)]))
+    return (similarities, standard_errors) if return_errors else similarities
+
+
+def _mean_and_standard_error(totals, squared_totals, n):
+    """Mean and standard error of the mean from running sums of values and of squared values"""
+    means = totals / n
+    variances = np.maximum(squared_totals / n - np.square(means), 0) * n / max(n - 1, 1)
+    return means, np.sqrt(variances / n)
+
+
+def _prefix_similarities(vocab_vectors, target_vector, word_counts, n_samples, rng):
+    """Similarity to the target of the first k words of n_samples random samples, for each k in sorted word_counts"""
+    indices = _sample_indices(len(vocab_vectors['rows']), word_counts[-1], n_samples, rng)
+    summed_vectors = np.cumsum(_word_vectors(vocab_vectors, indices), axis=1)[:, np.array(word_counts) - 1, :]
+    return _cosine_to_target(summed_vectors, target_vector)
+
+
+def adaptive_chance_similarities(vocab_vectors, target_vector, word_counts, tolerance=.001, max_samples=10000,
+                                 batch_size=1000, seed=None):
+    """Calculate the average chance similarity like chance_similarities, sampling only until it is precise enough.
+
+    Samples are drawn in batches of batch_size until the standard error of the average is at most tolerance for every
+    word count, or max_samples samples have been drawn.
+
+    Arguments
+    ---------
+    vocab_vectors: dict
+        word vectors from extract_vocab_vectors
+    target_vector: numpy array
+        vector of the target word
+    word_counts: list
+        positive word counts to calculate chance similarity for
+    tolerance: float, optional
+        standard error to stop sampling at (default .001)
+    max_samples: int, optional
+        most random samples to draw per word count (default 10,000)
+    batch_size: int, optional
+        number of samples drawn between checks of the standard error (default 1,000)
+    seed: int, optional
+        seed for the random number generator, for reproducible baselines
+
+    Returns
+    -------
+    (dict, dict)
+        keys for each word count with values for average similarity, and for the standard error of that average
+    """
+    word_counts = sorted({int(k) for k in word_counts})
+    if len(word_counts) == 0:
+        return {}, {}
+    rng = np.random.default_rng(seed)
+    target_vector = np.asarray(target_vector, dtype=np.float32)
+    sim_totals = np.zeros(len(word_counts))
+    squared_totals = np.zeros(len(word_counts))
+    n_drawn = 0
+    while n_drawn < max_samples:
+        n_batch = min(batch_size, max_samples - n_drawn)
+        similarities = _prefix_similarities(vocab_vectors, target_vector, word_counts, n_batch, rng)
+        instrumentation.count('bootstrap_samples', n_batch * len(word_counts))
+        sim_totals += similarities.sum(axis=0)
+        squared_totals += np.square(similarities).sum(axis=0)
+        n_drawn += n_batch
+        means, standard_errors = _mean_and_standard_error(sim_totals, squared_totals, n_drawn)
+        if standard_errors.max() <= tolerance:
+            break
+    return dict(zip(word_counts, means)), dict(zip(word_counts, standard_errors))
+
+
+def vocab_moments(vocab_vectors, chunk_size=100000):
+    """Mean and covariance of a vocabulary's word vectors (and of the normalized word vectors), for
+    analytic_chance_similarities
+
+    Arguments
+    ---------
+    vocab_vectors: dict
+        word vectors from extract_vocab_vectors
+    chunk_size: int, optional
+        number of table rows converted to double precision at a time, to limit memory use (default 100,000)
+
+    Returns
+    -------
+    {
+        n_words: int
+        mean: numpy array
+            mean word vector
+        covariance: numpy array
+            covariance matrix of the word vectors (divided by the number of words)
+        trace, squared_trace, mean_quadratic, mean_squared_norm: float
+            trace of the covariance, trace of its square, mean' covariance mean, and mean' mean
+        unit_mean, unit_covariance: numpy array
+            mean and covariance of the normalized word vectors (zero vectors stay zero)
+    }
+    """
+    data = vocab_vectors['data']
+    n_words, width = len(vocab_vectors['rows']), data.shape[1]
+    # each row of the table counts once for every word that has it
+    weights = np.bincount(vocab_vectors['rows'], minlength=len(data)).astype(np.float64)
+
+    def chunks():
+        for start in range(0, len(data), chunk_size):
+            vectors = np.asarray(data[start:start + chunk_size], dtype=np.float64)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            yield (vectors, np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms != 0),
+                   weights[start:start + chunk_size, None])
+
+    mean, unit_mean = np.zeros(width), np.zeros(width)
+    for vectors, unit_vectors, chunk_weights in chunks():
+        mean += (chunk_weights * vectors).sum(axis=0)
+        unit_mean += (chunk_weights * unit_vectors).sum(axis=0)
+    mean /= n_words
+    unit_mean /= n_words
+    covariance, unit_covariance = np.zeros((width, width)), np.zeros((width, width))
+    for vectors, unit_vectors, chunk_weights in chunks():
+        covariance += (vectors - mean).T @ (chunk_weights * (vectors - mean))
+        unit_covariance += (unit_vectors - unit_mean).T @ (chunk_weights * (unit_vectors - unit_mean))
+    covariance /= n_words
+    unit_covariance /= n_words
+    return {'n_words': n_words, 'mean': mean, 'covariance': covariance, 'trace': np.trace(covariance),
+            'squared_trace': np.sum(covariance * covariance), 'mean_quadratic': mean @ covariance @ mean,
+            'mean_squared_norm': mean @ mean, 'unit_mean': unit_mean, 'unit_covariance': unit_covariance}
+
+
+def _delta_method(moments, unit_target, word_counts):
+    """Second-order delta method estimate of the average similarity, its second-order term, and the first-order
+    standard deviation of single samples, for each word count (see analytic_chance_similarities)"""
+    target_covariance = moments['covariance'] @ unit_target
+    k = np.asarray(word_counts, dtype=np.float64)
+    n_words = moments['n_words']
+    # covariance of the mean of k words is the vocabulary covariance times scale (with finite population correction)
+    scale = (n_words - k) / (k * max(n_words - 1, 1))
+    mean_a = unit_target @ moments['mean']
+    mean_b = moments['mean_squared_norm'] + scale * moments['trace']
+    var_a = scale * (unit_target @ target_covariance)
+    cov_ab = 2 * scale * (target_covariance @ moments['mean'])
+    var_b = 2 * scale ** 2 * moments['squared_trace'] + 4 * scale * moments['mean_quadratic']
+    second_order = -.5 * cov_ab / mean_b ** 1.5 + .375 * mean_a * var_b / mean_b ** 2.5
+    sd = np.sqrt(np.maximum(var_a / mean_b - mean_a * cov_ab / mean_b ** 2 + mean_a ** 2 * var_b / (4 * mean_b ** 3),
+                            0))
+    return mean_a / np.sqrt(mean_b) + second_order, second_order, sd
+
+
+def analytic_chance_similarities(moments, target_vector, word_counts):
+    """Approximate the average chance similarity to the target from the vocabulary's mean and covariance, without
+    sampling.
+
+    For one word, the average similarity is exact: it is the similarity of the target to the mean normalized word
+    vector. For k > 1 words, the mean m of k words drawn without replacement has mean mu and covariance
+    S = Sigma / k * (N - k) / (N - 1). With t the unit target vector, the similarity is a / sqrt(b) for a = t'm and
+    b = m'm. Its expectation is approximated by a second-order Taylor expansion around (E[a], E[b]), with the moments
+    of a and b taken as if m were normally distributed:
+
+        E[a] = t'mu, E[b] = mu'mu + tr(S), Var(b) = 2 tr(S^2) + 4 mu'S mu, Cov(a, b) = 2 t'S mu
+
+    The approximation leaves out higher-order terms and treats word vectors as normally distributed, so it is biased
+    for short responses: on real vocabularies it can be off by more than its own second-order term at eight words
+    and fewer. The returned second-order term is only the size of the correction the expansion made, not an error bound;
+    flexibility_elaboration.bootstrap_similarity therefore samples short word counts instead (see its sample_up_to),
+    and benchmark.check_baselines compares these estimates with Monte Carlo ones on a model's vectors.
+
+    Arguments
+    ---------
+    moments: dict
+        output from vocab_moments
+    target_vector: numpy array
+        vector of the target word
+    word_counts: list
+        positive word counts to calculate chance similarity for
+
+    Returns
+    -------
+    (dict, dict, dict)
+        keys for each word count with values for average similarity, for the second-order term (0 for one word), and
+        for the standard deviation of the similarity of single random samples
+    """
+    word_counts = sorted({int(k) for k in word_counts})
+    if len(word_counts) == 0:
+        return {}, {}, {}
+    target_vector = np.asarray(target_vector, dtype=np.float64)
+    target_norm = np.linalg.norm(target_vector)
+    if target_norm == 0:
+        zeros = dict.fromkeys(word_counts, 0.)
+        return zeros, dict(zeros), dict(zeros)
+    unit_target = target_vector / target_norm
+    k = np.array(word_counts, dtype=np.float64)
+    estimates, second_order, sd = _delta_method(moments, unit_target, k)
+    single = k == 1
+    estimates[single] = unit_target @ moments['unit_mean']
+    second_order[single] = 0
+    sd[single] = np.sqrt(max(unit_target @ moments['unit_covariance'] @ unit_target, 0))
+    return dict(zip(word_counts, estimates)), dict(zip(word_counts, second_order)), dict(zip(word_counts, sd))
@@ -1,10 +1,13 @@
 import numpy as np
 
 
+def clean_tokens(doc):
+    """Tokens of a parsed response that are not punctuation, numbers, or stop words"""
+    return [token for token in doc if not (token.is_punct or token.like_num or token.is_stop)]
+
+
 def clean_text(text, nlp):
-    vec = nlp(text)
-    removed_punct = [token for token in vec if not token.is_punct]
-    removed_nums = [token for token in removed_punct if not token.like_num]
-    removed_stops = [token.text for token in removed_nums if not token.is_stop]
-    cleaned_text = ' '.join(removed_stops)
-    return cleaned_text if np.count_nonzero(nlp(cleaned_text).vector) != 0 else None
+    tokens = clean_tokens(nlp(text))
+    cleaned_text = ' '.join(token.text for token in tokens)
+    has_vector = len(tokens) > 0 and np.count_nonzero(np.mean([token.vector for token in tokens], axis=0)) != 0
+    return cleaned_text if has_vector else None
@@ -1,12 +1,17 @@
+import logging
 import pandas as pd
 import numpy as np
-import spacy
 from transform_data_by_response import transform_data_by_response
 from fluency import calc_fluency
 from flexibility_elaboration import calc_flexibility_and_elaboration
 from originality import calc_originality
+from models import get_nlp
+from calc_all_creativity import aggregate_by_subject
 
 
+# show progress messages from the scoring modules
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s')
+
 raw_data = pd.read_csv('data/raw_example_data.csv')
 data_by_response = transform_data_by_response(raw_data, delimiter='/', id_column='ID',
                                               response_column='Alternative Uses')
@@ -15,7 +20,7 @@ creativity = pd.DataFrame({'responseID': data_by_response.responseID,
 
 # load spacy vectors here, so we only have to do it once
 # first time using this, run `python -m spacy download en_vectors_web_lg` and `python -m spacy download en_core_web_md`
-nlp = spacy.load('en_vectors_web_lg')
+nlp = get_nlp('en_vectors_web_lg', vectors_only=True)
 creativity['fluency'] = calc_fluency(data_by_response, nlp, id_column='ID', response_column='response')
 creativity[['clean_response', 'elaboration', 'flexibility']] = \
     calc_flexibility_and_elaboration(list(data_by_response.response), u'pen', nlp)
@@ -31,23 +36,8 @@ creativity['z_elaboration'] = z_score(creativity.elaboration)
 creativity['z_flexibility'] = z_score(creativity.flexibility)
 creativity['z_originality'] = z_score(creativity.originality)
 
-creativity_by_participant = pd.DataFrame({'ID': creativity.ID.unique()})
-creativity_by_participant['z_elaboration'] = creativity_by_participant.apply(
-    lambda row:
-        np.nanmean(creativity.loc[creativity.ID == row.ID, 'z_elaboration']),
-    axis=1)
-creativity_by_participant['z_flexibility'] = creativity_by_participant.apply(
-    lambda row:
-        np.nanmean(creativity.loc[creativity.ID == row.ID, 'z_flexibility']),
-    axis=1)
-creativity_by_participant['z_originality'] = creativity_by_participant.apply(
-    lambda row:
-        np.nanmean(creativity.loc[creativity.ID == row.ID, 'z_originality']),
-    axis=1)
-creativity_by_participant['fluency'] = creativity_by_participant.apply(
-    lambda row:
-        np.nanmean(creativity.loc[creativity.ID == row.ID, 'fluency']),
-    axis=1)
+creativity_by_participant = aggregate_by_subject(
+    creativity, ['z_elaboration', 'z_flexibility', 'z_originality', 'fluency'], id_column='ID')
 # fluency is calculated on the participant level, so z score on the participant level
 creativity_by_participant['z_fluency'] = z_score(creativity_by_participant['fluency'])
 
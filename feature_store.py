@@ -0,0 +1,125 @@
+import hashlib
+import os
+import sqlite3
+from contextlib import closing
+import numpy as np
+
+# location of the feature store if no path is given: the UU_FEATURE_STORE environment variable, or this file
+STORE_PATH_ENV = 'UU_FEATURE_STORE'
+DEFAULT_STORE_PATH = os.path.join('features', 'features.sqlite')
+# SQLite journal mode of the store: write-ahead logging needs the store on a local disk; set
+# UU_FEATURE_JOURNAL_MODE=DELETE for a store on a network filesystem
+JOURNAL_MODE_ENV = 'UU_FEATURE_JOURNAL_MODE'
+DEFAULT_JOURNAL_MODE = 'WAL'
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+# SQLite limits the number of parameters per query
+_MAX_QUERY_KEYS = 900
+
+
+def get_store_path(path=None):
+    """Path of the feature store: path if given, else $UU_FEATURE_STORE, else features/features.sqlite"""
+    return path if path is not None else os.environ.get(STORE_PATH_ENV, DEFAULT_STORE_PATH)
+
+
+def get_journal_mode():
+    """Journal mode of the feature store: $UU_FEATURE_JOURNAL_MODE, else WAL"""
+    journal_mode = os.environ.get(JOURNAL_MODE_ENV, DEFAULT_JOURNAL_MODE).upper()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError('{} must be one of {}, not {!r}'.format(JOURNAL_MODE_ENV, ', '.join(JOURNAL_MODES),
+                                                                 journal_mode))
+    return journal_mode
+
+
+def _connect(path):
+    path = get_store_path(path)
+    journal_mode = get_journal_mode()
+    directory = os.path.dirname(path)
+    if directory != '':
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=60)
+    connection.execute('PRAGMA journal_mode=' + journal_mode)
+    connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                       'key TEXT PRIMARY KEY, clean_response TEXT, elaboration REAL, vector BLOB NOT NULL, '
+                       'lower_vector BLOB NOT NULL, flexibility REAL)')
+    connection.execute('CREATE TABLE IF NOT EXISTS fluency (key TEXT PRIMARY KEY, fluency REAL)')
+    return connection
+
+
+def _hash(*parts):
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def response_key(response, target, model_key):
+    """Key of a response's stored features: hash of the response text, target word, and model"""
+    return _hash(model_key, str(target), response)
+
+
+def participant_key(response_keys, model_key):
+    """Key of a participant's stored fluency: hash of the model and their response keys, in order"""
+    return _hash(model_key, *response_keys)
+
+
+def _read(table, columns, keys, path):
+    keys = list(dict.fromkeys(keys))
+    rows = []
+    with closing(_connect(path)) as connection:
+        for start in range(0, len(keys), _MAX_QUERY_KEYS):
+            batch = keys[start:start + _MAX_QUERY_KEYS]
+            rows += connection.execute('SELECT key, ' + columns + ' FROM ' + table + ' WHERE key IN ('
+                                       + ', '.join('?' * len(batch)) + ')', batch).fetchall()
+    return rows
+
+
+def read_response_features(keys, path=None):
+    """Read stored per-response features
+
+    Arguments
+    ---------
+    keys: list
+        response keys (see response_key)
+    path: str, optional
+        path of the SQLite file (see get_store_path)
+
+    Returns
+    -------
+    dict
+        keys for each stored response with (clean_response, elaboration, vector, lower_vector, flexibility) as value.
+        Responses that are not stored yet are left out.
+    """
+    return {key: (clean_response, np.nan if elaboration is None else elaboration,
+                  np.frombuffer(vector, dtype=np.float32), np.frombuffer(lower_vector, dtype=np.float32),
+                  np.nan if flexibility is None else flexibility)
+            for key, clean_response, elaboration, vector, lower_vector, flexibility in
+            _read('responses', 'clean_response, elaboration, vector, lower_vector, flexibility', keys, path)}
+
+
+def write_response_features(features, path=None):
+    """Store per-response features in one transaction
+
+    Arguments
+    ---------
+    features: dict
+        keys for each response with (clean_response, elaboration, vector, lower_vector, flexibility) as value
+    path: str, optional
+        path of the SQLite file (see get_store_path)
+    """
+    rows = [(key, clean_response, None if np.isnan(elaboration) else float(elaboration),
+             np.asarray(vector, dtype=np.float32).tobytes(), np.asarray(lower_vector, dtype=np.float32).tobytes(),
+             None if np.isnan(flexibility) else float(flexibility))
+            for key, (clean_response, elaboration, vector, lower_vector, flexibility) in features.items()]
+    with closing(_connect(path)) as connection:
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+
+def read_fluency(keys, path=None):
+    """Read stored fluency for participant keys (see participant_key). Participants not stored yet are left out."""
+    return dict(_read('fluency', 'fluency', keys, path))
+
+
+def write_fluency(fluency_by_key, path=None):
+    """Store fluency for participant keys (see participant_key) in one transaction"""
+    with closing(_connect(path)) as connection:
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO fluency VALUES (?, ?)',
+                                   [(key, float(fluency)) for key, fluency in fluency_by_key.items()])
@@ -1,11 +1,13 @@
+import logging
 import numpy as np
 import pandas as pd
-import spacy
-import random
-from clean_text import clean_text
-import glob
-import pickle
+import instrumentation
+from preprocess import preprocess_responses, embed_targets
+from chance_similarity import chance_similarities, adaptive_chance_similarities, analytic_chance_similarities
+from models import BASELINE_MODEL, get_nlp, get_vocab_vectors, get_vocab_moments, get_model_key
+from baseline_store import read_baselines, write_baselines
 
+logger = logging.getLogger(__name__)
 msg_prefix = '[FLEX] '
 
 
@@ -30,12 +32,21 @@ def calc_similarity(clean_response, target, nlp):
         return response_vec.similarity(target_vec) if np.count_nonzero(response_vec) != 0 else None
 
 
-def bootstrap_similarity(word_counts, target):
+def bootstrap_similarity(word_counts, target, n_samples=10000, seed=None, model_name=BASELINE_MODEL,
+                         store_path=None, method='bootstrap', tolerance=.001, return_errors=False, sample_up_to=16):
     """Calculate the average similarity for random words of each response length.
 
     Longer responses have higher similarity. To control for this, draw random words 10,000 times for each response
-    length. Calculate the average similarity for each response length. To save time, store bootstrap data for each
-    target word in a pickle.
+    length. Calculate the average similarity for each response length. Response lengths are sampled together in a few
+    batches (see chance_similarity.py). To save time, store bootstrap data in a SQLite baseline store keyed by model,
+    target word, word count, number of samples, and seed (see baseline_store.py).
+
+    Instead of a fixed number of samples, method='adaptive' samples until the standard error of each average is at
+    most tolerance (or n_samples samples are drawn), and method='analytic' approximates the averages from the
+    vocabulary's mean and covariance without sampling (see chance_similarity.analytic_chance_similarities). The
+    approximation is biased for short responses, so with method='analytic' word counts up to sample_up_to are sampled
+    like method='adaptive'. These are not stored; the analytic baselines take microseconds once the vocabulary
+    statistics are computed.
 
     Arguments
     ---------
@@ -43,50 +54,188 @@ def bootstrap_similarity(word_counts, target):
         List of unique elaboration scores
     target: string
         Target word
+    n_samples: int, optional
+        number of random samples per response length (default 10,000)
+    seed: int, optional
+        seed for the random number generator, for reproducible bootstraps
+    model_name: str, optional
+        Spacy model to draw random words from, taken from models.py (default 'en_core_web_md')
+    store_path: str, optional
+        path of the baseline store (see baseline_store.get_store_path)
+    method: str, optional
+        'bootstrap', 'adaptive', or 'analytic' (default 'bootstrap')
+    tolerance: float, optional
+        standard error to stop sampling at, for method='adaptive' (default .001)
+    return_errors: bool, optional
+        also return the error of each baseline (default False). For 'bootstrap' and 'adaptive' this is the standard
+        error of the average, so baseline +/- 1.96 * error is a 95% confidence interval. For 'analytic' the sampled
+        word counts get their standard error and the approximated ones get NaN, as the approximation has no error
+        estimate.
+    sample_up_to: int, optional
+        for method='analytic', largest word count to sample instead of approximating (default 16)
 
     Returns
     -------
-    bootstrapped similarities: object
-        keys for each word count with values for average similarity for that response length
+    bootstrapped similarities: object (or (object, object) if return_errors)
+        keys for each word count with values for average similarity for that response length (and for its error)
     """
-    nlp_smaller = spacy.load('en_core_web_md')
-    # check if this word has been corrected before
-    boot_filename = 'bootstraps/' + target + '.pkl'
-    stored_bootstraps = glob.glob(boot_filename)
-    print(msg_prefix + 'Correcting flexibility for word count for target word: ' + target)
-    if len(stored_bootstraps) == 0:
-        bootstrapped_sims = {}
-    else:
-        print(msg_prefix + 'Reading bootstrap data from file ' + stored_bootstraps[0])
-        boot_file = open(stored_bootstraps[0], 'rb')
-        bootstrapped_sims = pickle.load(boot_file)
-        boot_file.close()
+    logger.info(msg_prefix + 'Correcting flexibility for word count for target word: %s', target)
+    bootstrapped_sims = {}
+    errors = {}
+    sample_sizes = []
     for sample_size in word_counts:
-        sample_sims = []
         if (sample_size == 0) | (sample_size is None) | (np.isnan(sample_size)):
             bootstrapped_sims[sample_size] = 0
-            continue
-        elif sample_size in bootstrapped_sims:
-            continue
+            errors[sample_size] = 0
         else:
-            sample_size = sample_size.astype(int)
-        print(msg_prefix + 'Bootstrapping at word count ' + str(sample_size))
-        for i in list(range(0, 10000)):
-            sampled_keys = random.sample(nlp_smaller.vocab.vectors.keys(), sample_size)
-            while any([nlp_smaller.vocab[key].is_stop for key in sampled_keys]):
-                sampled_keys = random.sample(nlp_smaller.vocab.vectors.keys(), sample_size)
-            sampled_text = ' '.join([nlp_smaller.vocab[key].text for key in sampled_keys])
-            sim_to_target = nlp_smaller(sampled_text).similarity(nlp_smaller(target))
-            sample_sims.append(sim_to_target)
-        bootstrapped_sims[sample_size] = np.mean(sample_sims)
-    boot_file = open(boot_filename, 'wb')
-    pickle.dump(bootstrapped_sims, boot_file, -1)
-    boot_file.close()
-
-    return bootstrapped_sims
-
-
-def calc_flexibility_and_elaboration(responses, target_word, nlp):
+            sample_sizes.append(int(sample_size))
+    if method in ('adaptive', 'analytic'):
+        target_vector = get_nlp(model_name, vectors_only=True)(target).vector
+        sampled_sizes = [k for k in sample_sizes if method == 'adaptive' or k <= sample_up_to]
+        new_sims, new_errors = adaptive_chance_similarities(get_vocab_vectors(model_name), target_vector,
+                                                            sampled_sizes, tolerance, max_samples=n_samples,
+                                                            seed=seed)
+        logger.info(msg_prefix + 'Largest sampled baseline standard error: %.4f', max(new_errors.values(), default=0))
+        bootstrapped_sims.update(new_sims)
+        errors.update(new_errors)
+        approximated_sizes = [k for k in sample_sizes if k not in new_sims]
+        if len(approximated_sizes) > 0:
+            new_sims, _, _ = analytic_chance_similarities(get_vocab_moments(model_name), target_vector,
+                                                          approximated_sizes)
+            bootstrapped_sims.update(new_sims)
+            errors.update(dict.fromkeys(new_sims, np.nan))
+        return (bootstrapped_sims, errors) if return_errors else bootstrapped_sims
+    elif method != 'bootstrap':
+        raise ValueError("method must be 'bootstrap', 'adaptive', or 'analytic', not {!r}".format(method))
+    model_key = get_model_key(model_name)
+    # check if this word has been corrected before
+    stored_sims, stored_errors = read_baselines(model_key, target, sample_sizes, n_samples, seed, store_path,
+                                                with_errors=True)
+    bootstrapped_sims.update(stored_sims)
+    errors.update(stored_errors)
+    missing_counts = sorted(set(sample_sizes) - set(bootstrapped_sims))
+    instrumentation.count('baseline_cache_hits', len(set(sample_sizes)) - len(missing_counts))
+    instrumentation.count('baseline_cache_misses', len(missing_counts))
+    if len(missing_counts) > 0:
+        logger.info(msg_prefix + 'Bootstrapping at word counts %s', ', '.join(str(k) for k in missing_counts))
+        nlp_smaller = get_nlp(model_name, vectors_only=True)
+        new_sims, new_errors = chance_similarities(get_vocab_vectors(model_name), nlp_smaller(target).vector,
+                                                   missing_counts, n_samples=n_samples, seed=seed,
+                                                   return_errors=True)
+        write_baselines(model_key, target, new_sims, new_errors, n_samples, seed, store_path)
+        # read back, so concurrent jobs that bootstrapped the same word counts end up with the same baselines
+        stored_sims, stored_errors = read_baselines(model_key, target, missing_counts, n_samples, seed, store_path,
+                                                    with_errors=True)
+        bootstrapped_sims.update(stored_sims)
+        errors.update(stored_errors)
+
+    return (bootstrapped_sims, errors) if return_errors else bootstrapped_sims
+
+
+def target_similarities(vectors, target_codes, target_vectors):
+    """Cosine similarity between each response vector and the vector of its target, one dot product per target
+
+    Arguments
+    ---------
+    vectors: numpy array
+        one (lower-cased) response vector per row
+    target_codes: numpy array
+        index into target_vectors of each response's target
+    target_vectors: list
+        vector of each target word
+
+    Returns
+    -------
+    numpy array
+        similarity of each response (0 for responses without a vector)
+    """
+    norms = np.linalg.norm(vectors, axis=1)
+    similarities = np.zeros(len(vectors))
+    instrumentation.count('similarity_computations', len(vectors))
+    for code, target_vector in enumerate(target_vectors):
+        rows = np.flatnonzero(target_codes == code)
+        denominators = norms[rows] * np.linalg.norm(target_vector)
+        similarities[rows] = np.divide(vectors[rows] @ target_vector, denominators,
+                                       out=np.zeros(len(rows)), where=denominators != 0)
+    return similarities
+
+
+def _baseline_table(bootstrapped_sims):
+    """Turn a list of bootstrapped similarities (one dict per target) into a (target, word count) lookup array"""
+    max_count = max([int(k) for sims in bootstrapped_sims for k in sims if not np.isnan(k)] + [0])
+    table = np.zeros((len(bootstrapped_sims), max_count + 1))
+    for code, sims in enumerate(bootstrapped_sims):
+        for word_count, similarity in sims.items():
+            if not np.isnan(word_count):
+                table[code, int(word_count)] = similarity
+    return table
+
+
+def flexibility_from_similarity(raw_similarity, elaboration, target_codes, targets, bootstrapped_sims=None,
+                                baseline_method='bootstrap'):
+    """Correct raw similarity for chance similarity at each response's word count and invert it into flexibility
+
+    Arguments
+    ---------
+    raw_similarity: numpy array
+        similarity of each response to its target (NaN for responses without a vector)
+    elaboration: numpy array
+        word count of each response (NaN for responses without a vector)
+    target_codes: numpy array
+        index into targets of each response's target
+    targets: list
+        target words
+    bootstrapped_sims: list, optional
+        output from bootstrap_similarity for each target word, covering all word counts in elaboration. If not
+        provided, bootstrap_similarity is called for each target.
+    baseline_method: str, optional
+        method of bootstrap_similarity: 'bootstrap', 'adaptive', or 'analytic' (default 'bootstrap')
+
+    Returns
+    -------
+    numpy array
+        flexibility of each response
+    """
+    elaboration = np.asarray(elaboration, dtype=np.float64)
+    # to control for effects of response length (elaboration) on semantic similarity, calculate similarity expected by
+    # chance for all given response lengths to subtract from response similarity
+    # (Forthmann et al, 2018 https://doi.org/10.1002/jocb.240)
+    if bootstrapped_sims is None:
+        bootstrapped_sims = [bootstrap_similarity(pd.unique(elaboration[target_codes == code]), target,
+                                                  method=baseline_method)
+                             for code, target in enumerate(targets)]
+    baselines = _baseline_table(bootstrapped_sims)
+
+    has_response = ~np.isnan(elaboration)
+    corrected_similarity = np.array(raw_similarity, dtype=np.float64)
+    corrected_similarity[has_response] -= baselines[target_codes[has_response],
+                                                    elaboration[has_response].astype(int)]
+    # flexibility is dissimilarity score, so invert the similarity score to get flexibility
+    return 1 - np.abs(corrected_similarity)
+
+
+def calc_flexibility_from_features(features):
+    """Flexibility of each response in a compact feature set from response_features.py"""
+    return flexibility_from_similarity(features['similarity'], features['elaboration'], features['target_codes'],
+                                       features['targets'])
+
+
+def _flexibility_frame(responses, target_words, nlp, records, baseline_method):
+    """Calculate elaboration and flexibility for responses that each have their own target word"""
+    if records is None:
+        records = preprocess_responses(responses, nlp)
+    elaboration = records['elaboration']
+    target_codes, targets = pd.factorize(pd.Series(target_words))
+    vectors_by_target = embed_targets(targets, nlp)
+    target_vectors = [vectors_by_target[target] for target in targets]
+    raw_similarity = np.where(~np.isnan(elaboration),
+                              target_similarities(records['lower_vectors'], target_codes, target_vectors), np.nan)
+    return pd.DataFrame({'clean_response': records['clean_response'], 'elaboration': elaboration,
+                         'flexibility': flexibility_from_similarity(raw_similarity, elaboration, target_codes,
+                                                                    targets, baseline_method=baseline_method)})
+
+
+def calc_flexibility_and_elaboration(responses, target_word, nlp, records=None, baseline_method='bootstrap'):
     """Calculate flexibility (spacy similarity corrected for chance similarity) and elaboration (number of words).
 
     Arguments
@@ -94,53 +243,35 @@ def calc_flexibility_and_elaboration(responses, target_word, nlp):
         responses: list
         target_word: string
         nlp: Spacy model
+        records: dict, optional
+            output from preprocess.preprocess_responses for responses, to avoid parsing responses again
+        baseline_method: str, optional
+            how to calculate chance similarity: 'bootstrap', 'adaptive', or 'analytic' (see bootstrap_similarity)
 
     Returns
     -------
         pandas dataframe with 3 columns: clean_response, elaboration, flexibility
     """
-    data = pd.DataFrame({'clean_response': clean_text(response, nlp)} for response in responses)
-    data['elaboration'] = data.apply(lambda row: int(len(row.clean_response.split())) if
-                                     row.clean_response is not None else None, axis=1)
-    # to control for effects of response length (elaboration) on semantic similarity, calculate similarity expected by
-    # chance for all given response lengths to subtract from response similarity
-    # (Forthmann et al, 2018 https://doi.org/10.1002/jocb.240)
-    word_counts = data.elaboration.unique()
-    bootstrapped_sims = bootstrap_similarity(word_counts, target_word)
-
-    data['raw_similarity'] = data.apply(lambda row: calc_similarity(row.clean_response, target_word, nlp),
-                                        axis=1)
-    data['corrected_similarity'] = data.apply(
-        lambda row:
-            row.raw_similarity - bootstrapped_sims[row.elaboration] if not np.isnan(
-                row.elaboration) else row.raw_similarity,
-        axis=1)
-    # flexibility is dissimilarity score, so invert the similarity score to get flexibility
-    data['flexibility'] = (1 - abs(data['corrected_similarity']))
-    return data[['clean_response', 'elaboration', 'flexibility']]
+    return _flexibility_frame(responses, [target_word] * len(responses), nlp, records, baseline_method)
 
 
-def calc_flexibility_and_elaboration_multi_target(responses, target_words, nlp):
-    """"""
-    data = pd.DataFrame({'response': responses, 'target_word': target_words})
-    data['clean_response'] = [clean_text(response, nlp) for response in data.response]
-    data['elaboration'] = data.apply(lambda row: len(row.clean_response.split()) if
-                                     row.clean_response is not None else None, axis=1)
-    # to control for effects of response length (elaboration) on semantic similarity, calculate similarity expected by
-    # chance for all given response lengths to subtract from response similarity
-    # (Forthmann et al, 2018 https://doi.org/10.1002/jocb.240)
-    bootstrapped_sims = {}
-    for target in data.target_word.unique():
-        word_counts = data.elaboration.loc[data.target_word == target].unique()
-        bootstrapped_sims[target] = bootstrap_similarity(word_counts, target)
-
-    data['raw_similarity'] = data.apply(lambda row: calc_similarity(row.clean_response, row.target_word, nlp),
-                                        axis=1)
-    data['corrected_similarity'] = data.apply(
-        lambda row:
-            row.raw_similarity - bootstrapped_sims[row.target_word][row.elaboration] if not
-            np.isnan(row.elaboration) else row.raw_similarity,
-        axis=1)
-    # flexibility is dissimilarity score, so invert the similarity score to get flexibility
-    data['flexibility'] = (1 - abs(data['corrected_similarity']))
-    return data[['clean_response', 'elaboration', 'flexibility']]
+def calc_flexibility_and_elaboration_multi_target(responses, target_words, nlp, records=None,
+                                                  baseline_method='bootstrap'):
+    """Calculate flexibility and elaboration when responses were given to different target words.
+
+    Arguments
+    ---------
+        responses: list
+        target_words: list
+            target word of each response
+        nlp: Spacy model
+        records: dict, optional
+            output from preprocess.preprocess_responses for responses, to avoid parsing responses again
+        baseline_method: str, optional
+            how to calculate chance similarity: 'bootstrap', 'adaptive', or 'analytic' (see bootstrap_similarity)
+
+    Returns
+    -------
+        pandas dataframe with 3 columns: clean_response, elaboration, flexibility
+    """
+    return _flexibility_frame(responses, list(target_words), nlp, records, baseline_method)
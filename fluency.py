@@ -1,71 +1,440 @@
-import pandas as pd
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import instrumentation
+from models import DEFAULT_MODEL, get_nlp
+from preprocess import preprocess_responses
 
 
-def calculate_corrected_fluency(response_list, nlp):
-    threshold = .8
-    response_vecs = [nlp(response) for response in response_list]
-    clean_response_vecs = []
-    for response in response_vecs:
-        no_punct_list = [token for token in response
-                         if not token.is_punct]
-        no_num_list = [token for token in no_punct_list
-                       if not token.like_num]
-        no_stops_list = [token.text for token in no_num_list
-                         if not token.is_stop]
-        no_stops = nlp(' '.join(no_stops_list))
-        if np.count_nonzero(no_stops.vector) == 0:
-            continue
-        clean_response_vecs.append(no_stops)
-    merged = []
-    unique_resp_list = []
-    # loop thru responses except the last one (redundant for pairwise sim)
-    for index, resp in enumerate(clean_response_vecs[:-1]):
+def _unit_vectors(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms != 0)
+
+
+def merge_similar_responses(vectors, word_counts, threshold=.8, include_last=False):
+    """Greedily merge highly similar responses and return which responses were merged together.
+
+    Each response absorbs the most similar later response for as long as that similarity is at least the threshold.
+    A merged response's vector is the running (word count weighted) mean of the vectors merged into it. The similarity
+    matrix is computed once; after each merge only the similarities of the merged response are recalculated.
+
+    As in the original pairwise loop, a response that was already merged can still be absorbed by a later group, and
+    the last response never starts a group of its own: it is only counted if it is merged into an earlier group. This
+    off-by-one is kept on purpose by default, so fluency stays comparable with scores from earlier versions.
+
+    Arguments
+    ---------
+    vectors: numpy array
+        one mean word vector per (non-empty) cleaned response, in response order
+    word_counts: list
+        number of words in each cleaned response
+    threshold: float, optional
+        similarity at or above which two responses are merged (default .8)
+    include_last: bool, optional
+        let the last response start a group of its own if it was not merged, so every response is in a group
+        (default False)
+
+    Returns
+    -------
+    list
+        one list of response indices per unique response. The first index is the response that started the group,
+        followed by the responses merged into it in merge order.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    word_counts = np.asarray(word_counts, dtype=np.float64)
+    n_responses = len(vectors)
+    unit_vectors = _unit_vectors(vectors)
+    similarities = unit_vectors @ unit_vectors.T
+    instrumentation.count('similarity_computations', n_responses * n_responses)
+    merged = np.zeros(n_responses, dtype=bool)
+    groups = []
+    # loop thru responses except the last one (redundant for pairwise sim), unless it should get its own group
+    for index in range(n_responses if include_last else n_responses - 1):
         # skip if we already merged this response with another one
-        if index in merged:
-            continue
-        # also skip if there is no vector found for this response
-        # (i.e. it does not contain any words recognized by spacy)
-        if np.count_nonzero(resp.vector) == 0:
+        if merged[index]:
             continue
-        similarities = [resp.similarity(r) for r in
-                        clean_response_vecs[index + 1:]]
-        # for each response, check if most similar exceeds threshold.
-        max_similarity = max(similarities)
+        group = [index]
+        candidates = np.arange(index + 1, n_responses)
+        row = similarities[index, index + 1:]
+        new_vec, new_count = vectors[index].astype(np.float64), word_counts[index]
         # keep merging until most similar item is no longer above threshold.
-        # first, copy the response vector so we can modify it in the loop
-        # without messing with the original
-        response_vecs_copy = clean_response_vecs.copy()
-        new_resp = resp
-        while max_similarity >= threshold:
-            # get index of most similar item
-            merge_index = similarities.index(max_similarity) + index + 1
-            # use the index to get the most similar response
-            similar_resp = response_vecs_copy[merge_index]
+        while len(candidates) > 0 and row.max() >= threshold:
+            position = int(np.argmax(row))
+            merge_index = candidates[position]
             # combine current response and similar response into one
-            new_resp = nlp(new_resp.text + '. ' + similar_resp.text)
-            # put the new response at the current index
-            response_vecs_copy[index] = new_resp
-            # remove the merged response from the array
-            response_vecs_copy.pop(merge_index)
-            # find the index of the merged item in the original array
-            # add this to merged to skip it when the outer loop gets there
-            merged.append(clean_response_vecs.index(similar_resp))
-            # regenerate the similarity array with the modified responses
-            similarities = [new_resp.similarity(r) for r in
-                            response_vecs_copy[index + 1:]]
-            # re-calculate the max similarity.
-            # Loop will end if it's below threshold
-            max_similarity = (max(similarities) if len(similarities) >= 1
-                              else 0)
-        unique_resp_list.append(response_vecs_copy[index])
-    return len(unique_resp_list)
-
-
-def calc_fluency(response_df, nlp, id_column='ID', response_column='response'):
-    responses_by_id = {ID: list(response_df.loc[response_df[id_column] == ID, response_column]) for
-                       ID in response_df[id_column].unique()}
-    data = pd.DataFrame({id_column: response_df[id_column].unique()})
-    data['fluency'] = data.apply(lambda row: calculate_corrected_fluency(responses_by_id[row[id_column]], nlp), axis=1)
-    full_data = response_df.merge(data, on=id_column, sort=False)
-    return list(full_data['fluency'])
+            new_vec = (new_count * new_vec + word_counts[merge_index] * vectors[merge_index]) / \
+                (new_count + word_counts[merge_index])
+            new_count += word_counts[merge_index]
+            merged[merge_index] = True
+            group.append(int(merge_index))
+            # only the merged response changed, so only its similarities need to be updated
+            candidates = np.delete(candidates, position)
+            new_norm = np.linalg.norm(new_vec)
+            row = unit_vectors[candidates] @ (new_vec / new_norm) if new_norm != 0 else np.zeros(len(candidates))
+            instrumentation.count('similarity_computations', len(candidates))
+        groups.append(group)
+    return groups
+
+
+def _blocked_pairs(unit_vectors, threshold, block_size):
+    """Pairs (i < j) of rows of unit_vectors whose similarity is at least the threshold, block_size rows at a time"""
+    firsts, seconds = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)]
+    for start in range(0, len(unit_vectors), block_size):
+        similarities = unit_vectors[start:start + block_size] @ unit_vectors[start:].T
+        instrumentation.count('similarity_computations', similarities.size)
+        first, second = np.nonzero(np.triu(similarities >= threshold, 1))
+        firsts.append(first + start)
+        seconds.append(second + start)
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def _hash_codes(vectors, planes):
+    """Bucket of each vector: which side of each hyperplane it is on, as the bits of one integer"""
+    return ((vectors @ planes) >= 0) @ (2 ** np.arange(planes.shape[1] - 1, -1, -1, dtype=np.int64))
+
+
+def _largest_bucket(codes):
+    return np.unique(codes, return_counts=True)[1].max() if len(codes) > 0 else 0
+
+
+def _lsh_index(unit_vectors, n_bits, n_tables, max_bucket_size, rng):
+    """Random-hyperplane hash tables over unit vectors, as (hyperplanes, sorted bucket codes, response order) per table
+
+    A table whose largest bucket has more than max_bucket_size responses gets extra hyperplanes, up to twice n_bits,
+    so buckets stay small unless their responses are (nearly) identical.
+    """
+    tables = []
+    width = unit_vectors.shape[1]
+    for _ in range(n_tables):
+        planes = rng.standard_normal((width, n_bits)).astype(np.float32)
+        codes = _hash_codes(unit_vectors, planes)
+        while planes.shape[1] < 2 * n_bits and _largest_bucket(codes) > max_bucket_size:
+            plane = rng.standard_normal((width, 1)).astype(np.float32)
+            planes = np.hstack([planes, plane])
+            codes = codes * 2 + (unit_vectors @ plane[:, 0] >= 0)
+        order = np.argsort(codes, kind='stable')
+        tables.append((planes, codes[order], order))
+    return tables
+
+
+def _lsh_query(tables, vector, start):
+    """Responses after start that share a bucket with vector in any of the hash tables"""
+    members = [np.array([], dtype=np.int64)]
+    for planes, sorted_codes, order in tables:
+        code = _hash_codes(vector, planes)
+        members.append(order[np.searchsorted(sorted_codes, code, 'left'):np.searchsorted(sorted_codes, code, 'right')])
+    members = np.unique(np.concatenate(members))
+    return members[members > start]
+
+
+def find_candidate_pairs(vectors, threshold=.8, method='blocked', block_size=2048, n_bits=10, n_tables=32,
+                         max_bucket_size=1000, seed=0):
+    """Find pairs of responses whose similarity is at least the threshold, without a full similarity matrix.
+
+    'blocked' compares block_size responses at a time with all later responses, so it finds every pair while memory
+    grows linearly with the number of responses. 'lsh' hashes the normalized vectors with n_tables sets of n_bits
+    random hyperplanes and only compares responses that share a bucket, which takes subquadratic time but can miss
+    pairs: a pair with similarity s is found with probability 1 - (1 - (1 - arccos(s) / pi) ** n_bits) ** n_tables
+    (about .97 at s = .8 with the defaults). More tables find more pairs; more bits make buckets smaller. Tables with
+    buckets larger than max_bucket_size get more hyperplanes (see _lsh_index), and buckets that are still larger
+    (near-identical responses) are compared block_size responses at a time.
+
+    Arguments
+    ---------
+    vectors: numpy array
+        one vector per response
+    threshold: float, optional
+        lowest similarity of a pair (default .8)
+    method: str, optional
+        'blocked' (exact) or 'lsh' (approximate) (default 'blocked')
+    block_size: int, optional
+        responses per block for 'blocked' (default 2048)
+    n_bits: int, optional
+        hyperplanes per hash table for 'lsh' (default 10)
+    n_tables: int, optional
+        number of hash tables for 'lsh' (default 32)
+    max_bucket_size: int, optional
+        bucket size above which 'lsh' tables get extra hyperplanes (default 1000)
+    seed: int, optional
+        seed for the random hyperplanes of 'lsh' (default 0)
+
+    Returns
+    -------
+    (numpy array, numpy array)
+        first and second response index of each pair, with first < second, sorted by first then second
+    """
+    unit_vectors = _unit_vectors(np.asarray(vectors, dtype=np.float32))
+    n_responses = len(unit_vectors)
+    if method == 'blocked':
+        return _blocked_pairs(unit_vectors, threshold, block_size)
+    elif method != 'lsh':
+        raise ValueError("method must be 'blocked' or 'lsh', not {!r}".format(method))
+    firsts, seconds = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)]
+    for _, sorted_codes, order in _lsh_index(unit_vectors, n_bits, n_tables, max_bucket_size,
+                                             np.random.default_rng(seed)):
+        bucket_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        for bucket in np.split(order, bucket_starts[1:]):
+            if len(bucket) > 1:
+                bucket = np.sort(bucket)
+                first, second = _blocked_pairs(unit_vectors[bucket], threshold, block_size)
+                firsts.append(bucket[first])
+                seconds.append(bucket[second])
+    # the same pair can share a bucket in several hash tables
+    pair_keys = np.unique(np.concatenate(firsts).astype(np.int64) * n_responses + np.concatenate(seconds))
+    return pair_keys // n_responses, pair_keys % n_responses
+
+
+def merge_similar_responses_indexed(vectors, word_counts, threshold=.8, method='blocked', block_size=2048, n_bits=10,
+                                    n_tables=32, max_bucket_size=1000, seed=0):
+    """Greedily merge highly similar responses like merge_similar_responses, for pooled lists of many responses.
+
+    Unlike merge_similar_responses, every response is in a group, including the last one. Instead of computing a
+    full similarity matrix, each response is only compared with the later responses an index finds for it:
+
+    'blocked' finds all pairs above the threshold with find_candidate_pairs. After a merge, the group's new mean
+    vector is compared with every later response, as in merge_similar_responses, so the groups are the same as
+    merge_similar_responses(..., include_last=True). Memory grows linearly, time quadratically.
+
+    'lsh' looks up responses that share a hash bucket with the response, and after a merge also those that share a
+    bucket with the group's new mean vector (see find_candidate_pairs for the arguments). This takes subquadratic
+    time, but pairs the hash tables miss are not merged, so it can count slightly more unique responses.
+
+    Arguments
+    ---------
+    vectors: numpy array
+        one mean word vector per (non-empty) cleaned response, in response order
+    word_counts: list
+        number of words in each cleaned response
+    threshold: float, optional
+        similarity at or above which two responses are merged (default .8)
+    method: str, optional
+        'blocked' or 'lsh' (default 'blocked')
+    block_size, n_bits, n_tables, max_bucket_size, seed: optional
+        see find_candidate_pairs
+
+    Returns
+    -------
+    list
+        one list of response indices per unique response (see merge_similar_responses)
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    word_counts = np.asarray(word_counts, dtype=np.float64)
+    n_responses = len(vectors)
+    unit_vectors = _unit_vectors(vectors)
+    if method == 'blocked':
+        first, second = find_candidate_pairs(vectors, threshold, 'blocked', block_size=block_size)
+        # pairs are sorted by their first response, so each response's later neighbours are one slice of second
+        offsets = np.searchsorted(first, np.arange(n_responses + 1))
+    elif method == 'lsh':
+        tables = _lsh_index(unit_vectors, n_bits, n_tables, max_bucket_size, np.random.default_rng(seed))
+    else:
+        raise ValueError("method must be 'blocked' or 'lsh', not {!r}".format(method))
+
+    merged = np.zeros(n_responses, dtype=bool)
+    groups = []
+    for index in range(n_responses):
+        if merged[index]:
+            continue
+        group = [index]
+        candidates = second[offsets[index]:offsets[index + 1]] if method == 'blocked' else \
+            _lsh_query(tables, unit_vectors[index], index)
+        row = unit_vectors[candidates] @ unit_vectors[index]
+        instrumentation.count('similarity_computations', len(candidates))
+        new_vec, new_count = vectors[index].astype(np.float64), word_counts[index]
+        while len(candidates) > 0 and row.max() >= threshold:
+            position = int(np.argmax(row))
+            merge_index = candidates[position]
+            new_vec = (new_count * new_vec + word_counts[merge_index] * vectors[merge_index]) / \
+                (new_count + word_counts[merge_index])
+            new_count += word_counts[merge_index]
+            merged[merge_index] = True
+            group.append(int(merge_index))
+            new_norm = np.linalg.norm(new_vec)
+            # the group's mean moved, so look for responses that are similar to the new mean
+            if method == 'blocked':
+                candidates = np.setdiff1d(np.arange(index + 1, n_responses), group)
+            else:
+                candidates = np.delete(candidates, position)
+                if new_norm != 0:
+                    candidates = np.setdiff1d(np.union1d(candidates, _lsh_query(tables, new_vec / new_norm, index)),
+                                              group)
+            row = unit_vectors[candidates] @ (new_vec / new_norm) if new_norm != 0 else np.zeros(len(candidates))
+            instrumentation.count('similarity_computations', len(candidates))
+        groups.append(group)
+    return groups
+
+
+def pooled_fluency(vectors, word_counts, threshold=.8, method='blocked', **index_kwargs):
+    """Count unique ideas in a pooled list of responses (see merge_similar_responses_indexed)"""
+    return len(merge_similar_responses_indexed(vectors, word_counts, threshold, method, **index_kwargs))
+
+
+def calc_pooled_fluency(response_df, nlp=None, group_column=None, response_column='response', records=None,
+                        method='lsh', threshold=.8, **index_kwargs):
+    """Count unique ideas across the whole sample, or across each group of participants, by pooling their responses
+
+    Arguments
+    ---------
+    response_df: pandas dataframe
+        one row per response
+    nlp: Spacy model, optional
+        output from spacy.load(). If not provided, will load 'en_vectors_web_lg' through models.py.
+    group_column: str, optional
+        column with group labels. If not provided, all responses are pooled together.
+    response_column: str, optional
+        column with responses (default 'response')
+    records: dict, optional
+        output from preprocess.preprocess_responses for the rows of response_df, to avoid parsing responses again
+    method: str, optional
+        'blocked' (exact, quadratic time) or 'lsh' (approximate, subquadratic time) (default 'lsh')
+    threshold: float, optional
+        similarity at or above which two responses are merged (default .8)
+    **index_kwargs
+        passed on to merge_similar_responses_indexed
+
+    Returns
+    -------
+    int or dict
+        number of unique ideas, or keys for each group with its number of unique ideas as value
+    """
+    records = _get_records(response_df, nlp, response_column, records)
+    keep = ~np.isnan(records['elaboration'])
+    if group_column is None:
+        return pooled_fluency(records['vectors'][keep], records['elaboration'][keep], threshold, method,
+                              **index_kwargs)
+    return {group: pooled_fluency(records['vectors'][rows], records['elaboration'][rows], threshold, method,
+                                  **index_kwargs)
+            for group, rows in _rows_by_id(response_df, group_column, keep).items()}
+
+
+def corrected_fluency_from_vectors(vectors, word_counts, threshold=.8):
+    """Count unique responses after merging highly similar responses (see merge_similar_responses)"""
+    return len(merge_similar_responses(vectors, word_counts, threshold))
+
+
+def calculate_corrected_fluency(response_list, nlp):
+    records = preprocess_responses(response_list, nlp)
+    keep = ~np.isnan(records['elaboration'])
+    return corrected_fluency_from_vectors(records['vectors'][keep], records['elaboration'][keep])
+
+
+def _get_records(response_df, nlp, response_column, records):
+    """Preprocess the responses in response_df, unless records are already provided"""
+    if records is None:
+        if nlp is None:
+            nlp = get_nlp(DEFAULT_MODEL, vectors_only=True)
+        records = preprocess_responses(list(response_df[response_column]), nlp)
+    return records
+
+
+# response vectors and word counts of the worker process, set once per worker by _init_worker
+_worker_vectors = None
+_worker_word_counts = None
+
+
+def _init_worker(vectors, word_counts):
+    global _worker_vectors, _worker_word_counts
+    # a path to a .npy file is memory-mapped, so workers share the vectors instead of each receiving a copy
+    _worker_vectors = np.load(vectors, mmap_mode='r') if isinstance(vectors, str) else vectors
+    _worker_word_counts = word_counts
+
+
+def _worker_fluency(rows):
+    return corrected_fluency_from_vectors(_worker_vectors[rows], _worker_word_counts[rows])
+
+
+def _rows_by_id(response_df, id_column, keep):
+    """Positions of each participant's non-empty responses, from one groupby, in order of first appearance"""
+    groups = response_df.groupby(id_column, sort=False).indices
+    return {ID: rows[keep[rows]] for ID, rows in groups.items()}
+
+
+def _score_participants(vectors, word_counts, participant_rows, n_jobs, worker_vectors=None):
+    """Corrected fluency for each list of response positions in participant_rows, serially or in worker processes"""
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    if n_jobs > 1 and len(participant_rows) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(vectors if worker_vectors is None else worker_vectors,
+                                           word_counts)) as executor:
+            chunksize = max(1, len(participant_rows) // (n_jobs * 4))
+            return list(executor.map(_worker_fluency, participant_rows, chunksize=chunksize))
+    return [corrected_fluency_from_vectors(vectors[rows], word_counts[rows]) for rows in participant_rows]
+
+
+def calc_fluency(response_df, nlp=None, id_column='ID', response_column='response', records=None, n_jobs=1):
+    """Calculate corrected fluency for each participant
+
+    Arguments
+    ---------
+    response_df: pandas dataframe
+        one row per response
+    nlp: Spacy model, optional
+        output from spacy.load(). If not provided, will load 'en_vectors_web_lg' through models.py.
+    id_column: str, optional
+        column with participant IDs (default 'ID')
+    response_column: str, optional
+        column with responses (default 'response')
+    records: dict, optional
+        output from preprocess.preprocess_responses for the rows of response_df, to avoid parsing responses again
+    n_jobs: int, optional
+        number of worker processes to score participants with. Each worker receives the response vectors once.
+        -1 uses all CPUs. Results are the same as with the default serial scoring. (default 1)
+
+    Returns
+    -------
+    list
+        fluency of each response's participant, in the order of response_df
+    """
+    records = _get_records(response_df, nlp, response_column, records)
+    keep = ~np.isnan(records['elaboration'])
+    rows_by_id = _rows_by_id(response_df, id_column, keep)
+    fluency = _score_participants(records['vectors'], records['elaboration'], list(rows_by_id.values()), n_jobs)
+    fluency_by_id = dict(zip(rows_by_id.keys(), fluency))
+    return [fluency_by_id.get(ID, np.nan) for ID in response_df[id_column]]
+
+
+def calc_fluency_from_features(features, n_jobs=1):
+    """Calculate corrected fluency for each participant in a compact feature set from response_features.py
+
+    If the vectors are memory-mapped (load_response_features), worker processes map the same file instead of
+    receiving a copy of the vectors.
+
+    Returns
+    -------
+    numpy array
+        fluency of each participant, in the order of features['participants']
+    """
+    word_counts = np.asarray(features['elaboration'], dtype=np.float64)
+    codes = np.asarray(features['participant_codes'])
+    # responses without a participant ID (code -1) belong to no participant
+    rows = np.flatnonzero(~np.isnan(word_counts) & (codes >= 0))
+    rows = rows[np.argsort(codes[rows], kind='stable')]
+    split_at = np.searchsorted(codes[rows], np.arange(1, len(features['participants'])))
+    vectors = features['vectors']
+    worker_vectors = vectors.filename if isinstance(vectors, np.memmap) else None
+    return np.array(_score_participants(vectors, word_counts, np.split(rows, split_at), n_jobs, worker_vectors))
+
+
+def calc_fluency_groups(response_df, nlp=None, id_column='ID', response_column='response', records=None):
+    """Get the groups of merged responses behind each participant's corrected fluency, for auditing
+
+    Arguments are the same as for calc_fluency.
+
+    Returns
+    -------
+    dict
+        keys for each participant ID with {'groups': list of groups, 'uncounted': list of index labels} as value.
+        Each group is a list of index labels of response_df (see merge_similar_responses); the number of groups is
+        the participant's fluency. 'uncounted' holds the participant's last response if it was not merged into any
+        group, since corrected fluency does not count it, so every non-empty response shows up in the audit.
+    """
+    records = _get_records(response_df, nlp, response_column, records)
+    keep = ~np.isnan(records['elaboration'])
+    groups_by_id = {}
+    for ID, rows in _rows_by_id(response_df, id_column, keep).items():
+        groups = merge_similar_responses(records['vectors'][rows], records['elaboration'][rows])
+        grouped = {index for group in groups for index in group}
+        groups_by_id[ID] = {'groups': [list(response_df.index[rows[group]]) for group in groups],
+                            'uncounted': [response_df.index[rows[index]] for index in range(len(rows))
+                                          if index not in grouped]}
+    return groups_by_id
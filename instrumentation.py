@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# timers and counters of the current run in each thread, reset by start_report. Runs in different threads (e.g.
+# concurrent scoring service batches) keep separate reports instead of overwriting each other's.
+_local = threading.local()
+
+
+def _state():
+    if not hasattr(_local, 'state'):
+        _local.state = {'stages': {}, 'counters': Counter(), 'callback': None, 'start': time.perf_counter()}
+    return _local.state
+
+
+def start_report(progress_callback=None):
+    """Reset all stage timers and counters of this thread and start a new timing report
+
+    Arguments
+    ---------
+    progress_callback: function, optional
+        called with one dict per event: {'stage': name, 'event': 'start'}, {'stage': name, 'event': 'end',
+        'seconds': seconds}, or {'stage': name, 'event': 'progress', 'done': n, 'total': n}. total is None when the
+        total is not known in advance (e.g. while streaming a file).
+    """
+    _state().update(stages={}, counters=Counter(), callback=progress_callback, start=time.perf_counter())
+
+
+def _notify(event):
+    callback = _state()['callback']
+    if callback is not None:
+        callback(event)
+
+
+def count(name, n=1):
+    """Add n to a counter, e.g. 'docs_parsed' or 'baseline_cache_hits'"""
+    _state()['counters'][name] += int(n)
+
+
+def progress(name, done, total):
+    """Report progress within a stage. total may be None if it is not known."""
+    logger.debug('%s: %s/%s', name, done, '?' if total is None else total)
+    _notify({'stage': name, 'event': 'progress', 'done': done, 'total': total})
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of a run. Time spent in a stage that runs several times (e.g. once per chunk) is added up."""
+    logger.info('Starting %s', name)
+    _notify({'stage': name, 'event': 'start'})
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        timing = _state()['stages'].setdefault(name, {'seconds': 0., 'calls': 0})
+        timing['seconds'] += seconds
+        timing['calls'] += 1
+        logger.info('Finished %s in %.2fs', name, seconds)
+        _notify({'stage': name, 'event': 'end', 'seconds': seconds})
+
+
+def get_report():
+    """Timing report of the current run in this thread
+
+    Counters only include work done in this thread (not in fluency worker processes or other threads).
+
+    Returns
+    -------
+    {
+        total_seconds: float
+            time since start_report
+        stages: dict
+            keys for each stage with {'seconds': total seconds, 'calls': number of times the stage ran} as value
+        counters: dict
+            keys for each counter with its count as value
+    }
+    """
+    state = _state()
+    return {'total_seconds': time.perf_counter() - state['start'],
+            'stages': {name: dict(timing) for name, timing in state['stages'].items()},
+            'counters': dict(state['counters'])}
@@ -0,0 +1,134 @@
+import logging
+import os
+import spacy
+from chance_similarity import extract_vocab_vectors, vocab_moments
+
+logger = logging.getLogger(__name__)
+msg_prefix = '[MODELS] '
+
+# model used to score responses, and smaller model used to bootstrap chance similarity
+DEFAULT_MODEL = 'en_vectors_web_lg'
+BASELINE_MODEL = 'en_core_web_md'
+
+# pipeline components that are not needed when only the vocabulary and its vectors are used.
+# The token attributes used in this repo (is_punct, like_num, is_stop, vector) are lexical, so they still work.
+VECTOR_ONLY_DISABLE = ['tagger', 'parser', 'ner', 'textcat', 'entity_ruler', 'entity_linker', 'sentencizer',
+                       'senter', 'morphologizer', 'attribute_ruler', 'lemmatizer', 'tok2vec']
+
+_pipelines = {}
+_vocab_vectors = {}
+_vocab_moments = {}
+_model_keys = {}
+
+
+def get_nlp(model_name=DEFAULT_MODEL, vectors_only=False):
+    """Get a Spacy model, loading it the first time it is requested in this process.
+
+    Arguments
+    ---------
+    model_name: str, optional
+        name of the Spacy model (default 'en_vectors_web_lg')
+    vectors_only: bool, optional
+        load the model with its parsers disabled, for when only tokens and vectors are used. A fully loaded model is
+        reused if there is one. (default False)
+
+    Returns
+    -------
+    Spacy model
+    """
+    if (model_name, False) in _pipelines:
+        return _pipelines[(model_name, False)]
+    if (model_name, vectors_only) not in _pipelines:
+        logger.info(msg_prefix + 'Loading spacy model: %s', model_name)
+        _pipelines[(model_name, vectors_only)] = (spacy.load(model_name, disable=VECTOR_ONLY_DISABLE) if vectors_only
+                                                  else spacy.load(model_name))
+    return _pipelines[(model_name, vectors_only)]
+
+
+def register_nlp(model_name, nlp):
+    """Use an already loaded Spacy model whenever model_name is requested, e.g. a small local vector table for tests
+    and benchmarks that need to run offline"""
+    _pipelines[(model_name, False)] = nlp
+    _vocab_vectors.pop(model_name, None)
+    _vocab_moments.pop(model_name, None)
+    _model_keys.pop(model_name, None)
+
+
+def get_vocab_vectors(model_name=BASELINE_MODEL):
+    """Get the non-stop-word vectors of a Spacy model, extracting them the first time they are requested.
+
+    Arguments
+    ---------
+    model_name: str, optional
+        name of the Spacy model (default 'en_core_web_md')
+
+    Returns
+    -------
+    dict
+        vector table and the row of each word (see chance_similarity.extract_vocab_vectors)
+    """
+    if model_name not in _vocab_vectors:
+        _vocab_vectors[model_name] = extract_vocab_vectors(get_nlp(model_name, vectors_only=True))
+    return _vocab_vectors[model_name]
+
+
+def get_vocab_moments(model_name=BASELINE_MODEL):
+    """Get the mean and covariance of a Spacy model's non-stop-word vectors, computing them the first time they are
+    requested.
+
+    Arguments
+    ---------
+    model_name: str, optional
+        name of the Spacy model (default 'en_core_web_md')
+
+    Returns
+    -------
+    dict
+        see chance_similarity.vocab_moments
+    """
+    if model_name not in _vocab_moments:
+        _vocab_moments[model_name] = vocab_moments(get_vocab_vectors(model_name))
+    return _vocab_moments[model_name]
+
+
+def nlp_model_key(nlp):
+    """Name and version of a loaded Spacy model, e.g. 'en_core_web_md-2.3.1', to key stored results by"""
+    return '{}_{}-{}'.format(nlp.meta.get('lang', ''), nlp.meta.get('name', ''), nlp.meta.get('version', 'unknown'))
+
+
+def _model_meta(model_name):
+    """meta.json of an installed model package or model directory, or None if it cannot be found"""
+    if os.path.isdir(model_name):
+        path = model_name
+    elif spacy.util.is_package(model_name):
+        path = spacy.util.get_package_path(model_name)
+    else:
+        return None
+    meta_path = os.path.join(str(path), 'meta.json')
+    return spacy.util.get_model_meta(path) if os.path.exists(meta_path) else None
+
+
+def get_model_key(model_name=BASELINE_MODEL):
+    """Name and version of a Spacy model, e.g. 'en_core_web_md-2.3.1', to key stored results by
+
+    The key is read from the model's meta.json, so the model is only loaded if it is not installed as a package or
+    directory (e.g. a model passed to register_nlp, which is already loaded).
+    """
+    if model_name not in _model_keys:
+        loaded = [nlp for (name, _), nlp in _pipelines.items() if name == model_name]
+        meta = None if len(loaded) > 0 else _model_meta(model_name)
+        if meta is not None:
+            _model_keys[model_name] = '{}_{}-{}'.format(meta.get('lang', ''), meta.get('name', ''),
+                                                        meta.get('version', 'unknown'))
+        else:
+            _model_keys[model_name] = nlp_model_key(loaded[0] if len(loaded) > 0
+                                                    else get_nlp(model_name, vectors_only=True))
+    return _model_keys[model_name]
+
+
+def clear_models():
+    """Drop all cached models and vector tables, e.g. to free memory"""
+    _pipelines.clear()
+    _vocab_vectors.clear()
+    _vocab_moments.clear()
+    _model_keys.clear()
@@ -1,16 +1,86 @@
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 import pandas as pd
 import numpy as np
+import pickle
 
 
-def calc_originality(responses, clusters=8):
-    responses = [' ' if pd.isnull(r) else r for r in responses]
+def _clean_responses(responses):
+    return [' ' if pd.isnull(r) else r for r in responses]
+
+
+def fit_originality(responses, clusters=8, mini_batch=False, random_state=None, batch_size=1024):
+    """Fit the TF-IDF vectorizer and response clusters that originality is measured against
+
+    Arguments
+    ---------
+    responses: list
+        reference responses, e.g. a norm sample or a random sample of a larger dataset
+    clusters: int, optional
+        number of response clusters (default 8)
+    mini_batch: bool, optional
+        cluster with MiniBatchKMeans instead of KMeans, which is much faster for large reference sets (default False)
+    random_state: int, optional
+        seed for the clustering, so that fits are reproducible
+    batch_size: int, optional
+        number of responses per mini batch if mini_batch is True (default 1024)
+
+    Returns
+    -------
+    {
+        vectorizer: fitted TfidfVectorizer
+        cluster_model: fitted KMeans or MiniBatchKMeans model
+        centroids: numpy array with the cluster centers
+    }
+    """
     vectorizer = TfidfVectorizer()
-    responses_tfidf = vectorizer.fit_transform(responses)
-    cluster_model = KMeans(n_clusters=clusters)
-    responses_cluster_distances = cluster_model.fit_transform(responses_tfidf)
-    nearest_cluster_distances = np.min(responses_cluster_distances, axis=1)
-    return nearest_cluster_distances
+    responses_tfidf = vectorizer.fit_transform(_clean_responses(responses))
+    cluster_model = MiniBatchKMeans(n_clusters=clusters, batch_size=batch_size, random_state=random_state) \
+        if mini_batch else KMeans(n_clusters=clusters, random_state=random_state)
+    cluster_model.fit(responses_tfidf)
+    return {'vectorizer': vectorizer, 'cluster_model': cluster_model, 'centroids': cluster_model.cluster_centers_}
+
+
+def nearest_centroid_distances(responses_tfidf, centroids, chunk_size=10000):
+    """Euclidean distance from each (sparse) TF-IDF row to its nearest centroid.
+
+    Uses |x - c|^2 = |x|^2 - 2 x.c + |c|^2, so the sparse matrix is only multiplied with the centroids and never
+    densified. Rows are processed in chunks to bound memory.
+    """
+    centroid_norms = np.sum(centroids ** 2, axis=1)
+    distances = np.empty(responses_tfidf.shape[0])
+    for start in range(0, responses_tfidf.shape[0], chunk_size):
+        chunk = responses_tfidf[start:start + chunk_size]
+        row_norms = np.asarray(chunk.multiply(chunk).sum(axis=1)).ravel()
+        squared = row_norms[:, None] - 2 * np.asarray(chunk @ centroids.T) + centroid_norms[None, :]
+        distances[start:start + chunk_size] = np.sqrt(np.maximum(squared.min(axis=1), 0))
+    return distances
+
+
+def score_originality(originality_model, responses):
+    """Distance of each response to its nearest cluster in a model from fit_originality, without refitting"""
+    responses_tfidf = originality_model['vectorizer'].transform(_clean_responses(responses))
+    return nearest_centroid_distances(responses_tfidf, originality_model['centroids'])
+
+
+def save_originality_model(originality_model, path):
+    """Save a model from fit_originality to a pickle file, e.g. to score new responses against a fixed norm"""
+    with open(path, 'wb') as model_file:
+        pickle.dump(originality_model, model_file, -1)
+
+
+def load_originality_model(path):
+    """Load a model saved with save_originality_model"""
+    with open(path, 'rb') as model_file:
+        return pickle.load(model_file)
+
+
+def calc_originality(responses, clusters=8, mini_batch=False, random_state=None):
+    return score_originality(fit_originality(responses, clusters, mini_batch, random_state), responses)
 
 
+def calc_originality_from_features(features, originality_model=None):
+    """Originality of each response in a compact feature set from response_features.py"""
+    if originality_model is None:
+        return calc_originality(features['response'])
+    return score_originality(originality_model, features['response'])
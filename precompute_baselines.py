@@ -0,0 +1,88 @@
+"""Fill the baseline store with chance similarities for a list of target words ahead of scoring.
+
+Example:
+    python precompute_baselines.py pen brick paperclip --max-elaboration 20 --jobs 4
+"""
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from flexibility_elaboration import bootstrap_similarity
+from models import BASELINE_MODEL
+
+logger = logging.getLogger(__name__)
+msg_prefix = '[PRECOMPUTE] '
+
+
+def _bootstrap_target(target, max_elaboration, n_samples, seed, model_name, store_path):
+    bootstrap_similarity(range(1, max_elaboration + 1), target, n_samples=n_samples, seed=seed,
+                         model_name=model_name, store_path=store_path)
+    return target
+
+
+def precompute_baselines(targets, max_elaboration, n_samples=10000, seed=None, model_name=BASELINE_MODEL,
+                         store_path=None, n_jobs=1):
+    """Bootstrap chance similarity for word counts 1 to max_elaboration for each target word.
+
+    Targets are bootstrapped in parallel worker processes. Each worker loads the model once and reuses it for all the
+    targets it gets. Word counts that are already in the store are skipped.
+
+    Arguments
+    ---------
+    targets: list
+        target words
+    max_elaboration: int
+        highest word count to bootstrap
+    n_samples: int, optional
+        number of random samples per word count (default 10,000)
+    seed: int, optional
+        seed for the random number generator
+    model_name: str, optional
+        Spacy model to draw random words from (default 'en_core_web_md')
+    store_path: str, optional
+        path of the baseline store (see baseline_store.get_store_path)
+    n_jobs: int, optional
+        number of worker processes, -1 to use all CPUs (default 1)
+    """
+    targets = list(dict.fromkeys(targets))
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    args = (max_elaboration, n_samples, seed, model_name, store_path)
+    start = time.time()
+    if n_jobs <= 1:
+        done = (_bootstrap_target(target, *args) for target in targets)
+        for i, target in enumerate(done, 1):
+            logger.info(msg_prefix + '[%d/%d] %s done (%.0fs)', i, len(targets), target, time.time() - start)
+        return
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(_bootstrap_target, target, *args) for target in targets]
+        for i, future in enumerate(as_completed(futures), 1):
+            logger.info(msg_prefix + '[%d/%d] %s done (%.0fs)', i, len(targets), future.result(),
+                        time.time() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Precompute chance similarity baselines for target words.')
+    parser.add_argument('targets', nargs='*', help='target words')
+    parser.add_argument('--targets-file', help='file with one target word per line')
+    parser.add_argument('--max-elaboration', type=int, required=True, help='highest word count to bootstrap')
+    parser.add_argument('--n-samples', type=int, default=10000, help='random samples per word count')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the random number generator')
+    parser.add_argument('--model', default=BASELINE_MODEL, help='Spacy model to draw random words from')
+    parser.add_argument('--store', default=None, help='path of the baseline store')
+    parser.add_argument('--jobs', type=int, default=1, help='number of worker processes, -1 for all CPUs')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    targets = list(args.targets)
+    if args.targets_file is not None:
+        with open(args.targets_file) as targets_file:
+            targets += [line.strip() for line in targets_file if line.strip() != '']
+    if len(targets) == 0:
+        parser.error('provide target words or --targets-file')
+    precompute_baselines(targets, args.max_elaboration, n_samples=args.n_samples, seed=args.seed,
+                         model_name=args.model, store_path=args.store, n_jobs=args.jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import logging
+import numpy as np
+from clean_text import clean_tokens
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+msg_prefix = '[PREPROCESS] '
+
+
+def preprocess_responses(responses, nlp, batch_size=1000):
+    """Parse every response once and keep only what the creativity metrics need.
+
+    Responses are parsed in batches with nlp.pipe. Fluency, elaboration, and flexibility all read from the returned
+    records, so no response has to be parsed again.
+
+    Arguments
+    ---------
+    responses: list
+        response strings (missing responses are treated as empty)
+    nlp: Spacy model
+        output from spacy.load()
+    batch_size: int, optional
+        number of responses per nlp.pipe batch (default 1000)
+
+    Returns
+    -------
+    {
+        clean_response: list
+            response with punctuation, numbers, and stop words removed, or None if no word in it has a vector
+        elaboration: numpy array
+            number of words in clean_response (NaN if clean_response is None)
+        vectors: numpy array
+            float32 matrix with the mean word vector of each clean_response (zeros if clean_response is None)
+        lower_vectors: numpy array
+            same as vectors, but for the lower-cased clean_response
+    }
+    """
+    texts = ['' if not isinstance(r, str) else r for r in responses]
+    clean_responses = []
+    elaboration = np.full(len(texts), np.nan)
+    vectors = np.zeros((len(texts), nlp.vocab.vectors_length), dtype=np.float32)
+    lower_vectors = np.zeros_like(vectors)
+    logger.info(msg_prefix + 'Parsing %d responses', len(texts))
+    for i, doc in enumerate(nlp.pipe(texts, batch_size=batch_size)):
+        instrumentation.count('docs_parsed')
+        if (i + 1) % batch_size == 0:
+            instrumentation.progress('preprocess', i + 1, len(texts))
+        tokens = clean_tokens(doc)
+        if len(tokens) > 0:
+            vectors[i] = np.mean([token.vector for token in tokens], axis=0)
+        if np.count_nonzero(vectors[i]) == 0:
+            clean_responses.append(None)
+            continue
+        clean_response = ' '.join(token.text for token in tokens)
+        clean_responses.append(clean_response)
+        elaboration[i] = len(clean_response.split())
+        lower_vectors[i] = np.mean([nlp.vocab.get_vector(token.lower_) for token in tokens], axis=0)
+    return {'clean_response': clean_responses, 'elaboration': elaboration,
+            'vectors': vectors, 'lower_vectors': lower_vectors}
+
+
+def subset_records(records, rows):
+    """Records (from preprocess_responses) of the responses at positions rows"""
+    rows = np.asarray(rows, dtype=int)
+    return {name: [values[i] for i in rows] if isinstance(values, list) else values[rows]
+            for name, values in records.items()}
+
+
+def embed_targets(targets, nlp):
+    """Get the vector of each unique target word, parsing each one only once
+
+    Arguments
+    ---------
+    targets: list
+        target words
+    nlp: Spacy model
+
+    Returns
+    -------
+    dict
+        keys for each unique target word with its float32 vector as value
+    """
+    targets = set(targets)
+    instrumentation.count('docs_parsed', len(targets))
+    return {target: np.asarray(nlp(target).vector, dtype=np.float32) for target in targets}
@@ -0,0 +1,105 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from preprocess import preprocess_responses, embed_targets
+from flexibility_elaboration import target_similarities
+from models import DEFAULT_MODEL, get_nlp
+
+# numeric columns, each saved to its own .npy file so it can be memory-mapped
+ARRAY_NAMES = ['participant_codes', 'target_codes', 'elaboration', 'similarity', 'vectors']
+# labels and text, saved together in a JSON file
+TEXT_NAMES = ['responseID', 'participants', 'targets', 'response', 'clean_response']
+
+
+def build_response_features(data_by_response, target_word=None, nlp=None, multi_target=False, records=None):
+    """Build a compact columnar set of per-response features that all metric modules can read
+
+    Participants and target words are stored as integer codes, and vectors as one float32 matrix. No Spacy objects
+    or per-response Python objects other than the response text are kept.
+
+    Arguments
+    ---------
+    data_by_response: pandas dataframe
+        one row per response (see calc_all_creativity)
+    target_word: str, optional
+        task's target word, if multi_target is False
+    nlp: Spacy model, optional
+        output from spacy.load(). If not provided, will load 'en_vectors_web_lg' through models.py.
+    multi_target: bool, optional
+        True if data_by_response has a 'target_word' column with each response's target (default False)
+    records: dict, optional
+        output from preprocess.preprocess_responses for data_by_response, to avoid parsing responses again
+
+    Returns
+    -------
+    {
+        responseID: list
+        participant_codes: int32 array, index into participants of each response's participant
+        participants: list of participant IDs
+        target_codes: int32 array, index into targets of each response's target word
+        targets: list of target words
+        elaboration: float32 array (NaN for responses without a vector)
+        similarity: float32 array, raw similarity to the target word (NaN for responses without a vector)
+        vectors: float32 matrix of mean word vectors (used for fluency)
+        response: list of responses
+        clean_response: list of cleaned responses
+    }
+    """
+    if nlp is None:
+        nlp = get_nlp(DEFAULT_MODEL, vectors_only=True)
+    responses = list(data_by_response.response)
+    if records is None:
+        records = preprocess_responses(responses, nlp)
+    participant_codes, participants = pd.factorize(data_by_response.ID)
+    target_words = list(data_by_response.target_word) if multi_target else [target_word] * len(responses)
+    target_codes, targets = pd.factorize(pd.Series(target_words))
+    vectors_by_target = embed_targets(targets, nlp)
+    similarity = np.where(~np.isnan(records['elaboration']),
+                          target_similarities(records['lower_vectors'], target_codes,
+                                              [vectors_by_target[target] for target in targets]),
+                          np.nan)
+    return {'responseID': list(data_by_response.responseID),
+            'participant_codes': participant_codes.astype(np.int32), 'participants': list(participants),
+            'target_codes': target_codes.astype(np.int32), 'targets': list(targets),
+            'elaboration': records['elaboration'].astype(np.float32), 'similarity': similarity.astype(np.float32),
+            'vectors': np.asarray(records['vectors'], dtype=np.float32),
+            'response': ['' if not isinstance(r, str) else r for r in responses],
+            'clean_response': records['clean_response']}
+
+
+def _to_json(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def save_response_features(features, directory):
+    """Save features from build_response_features to a directory (one .npy file per array, plus text.json)"""
+    os.makedirs(directory, exist_ok=True)
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(directory, name + '.npy'), features[name])
+    with open(os.path.join(directory, 'text.json'), 'w') as text_file:
+        json.dump({name: [_to_json(v) for v in features[name]] for name in TEXT_NAMES}, text_file)
+
+
+def load_response_features(directory, mmap_mode='r'):
+    """Load features saved with save_response_features.
+
+    Arrays are memory-mapped by default, so several processes can read the same vectors without copying them into
+    memory.
+
+    Arguments
+    ---------
+    directory: str
+        directory passed to save_response_features
+    mmap_mode: str, optional
+        mmap_mode passed to np.load, None to read arrays into memory (default 'r')
+
+    Returns
+    -------
+    dict
+        see build_response_features
+    """
+    features = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in ARRAY_NAMES}
+    with open(os.path.join(directory, 'text.json')) as text_file:
+        features.update(json.load(text_file))
+    return features
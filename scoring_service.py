@@ -0,0 +1,304 @@
+"""Long-lived scoring service for scoring participants' responses as they come in.
+
+Models, baselines, and the reference norm are loaded once. New responses are scored against the fixed norm: z scores
+use the reference mean and standard deviation, and originality uses clusters fitted on the reference responses.
+
+Example:
+    service = ScoringService(reference_data, target_word='pen')
+    service.score_participant('P1', ['hair bun holder', 'ruler', 'dart'])
+
+    # or, from asyncio code, with concurrent requests micro-batched together
+    async with AsyncScoringService(service) as async_service:
+        result = await async_service.score_participant('P1', ['hair bun holder', 'ruler', 'dart'])
+"""
+import asyncio
+import logging
+import numpy as np
+import pandas as pd
+from calc_all_creativity import RESPONSE_METRICS, score_responses, add_z_scores, summarize_by_subject
+from flexibility_elaboration import bootstrap_similarity, target_similarities, flexibility_from_similarity
+from fluency import calc_fluency
+from originality import fit_originality, score_originality
+from preprocess import preprocess_responses, embed_targets
+from models import DEFAULT_MODEL, get_nlp
+
+logger = logging.getLogger(__name__)
+msg_prefix = '[SERVICE] '
+
+
+class ScoringService:
+    """Score responses against a fixed reference norm with models and baselines kept in memory
+
+    Arguments
+    ---------
+    reference_data: pandas dataframe, optional
+        norm sample with one row per response (see calc_all_creativity). Its scores set the means and standard
+        deviations for z scoring, and originality clusters are fitted on it unless originality_model is given.
+    target_word: str, optional
+        task's target word, if multi_target is False
+    multi_target: bool, optional
+        True if data to score has a 'target_word' column with each response's target (default False)
+    nlp: Spacy model, optional
+        output from spacy.load(). If not provided, will load 'en_vectors_web_lg' through models.py.
+    originality_model: dict, optional
+        output from originality.fit_originality to measure originality against
+    z_stats: dict, optional
+        (mean, standard deviation) for 'elaboration', 'flexibility', 'originality', and subject 'fluency', e.g. from
+        streaming.calc_all_creativity_streaming. Required (with originality_model) if reference_data is not given.
+    warm_targets: list, optional
+        target words to bootstrap baselines for up front (default target_word)
+    max_elaboration: int, optional
+        highest word count to bootstrap up front for warm_targets (default 20)
+    batch_size: int, optional
+        nlp.pipe batch size (default 256)
+    baseline_method: str, optional
+        how to calculate chance similarity for new word counts and targets: 'bootstrap', 'adaptive', or 'analytic'
+        (see flexibility_elaboration.bootstrap_similarity). 'analytic' makes baselines for new targets much cheaper.
+        (default 'bootstrap')
+    random_state: int, optional
+        seed for fitting the originality clusters on reference_data, so that services built on the same reference
+        data score originality the same way
+    """
+
+    def __init__(self, reference_data=None, target_word=None, multi_target=False, nlp=None, originality_model=None,
+                 z_stats=None, warm_targets=None, max_elaboration=20, batch_size=256, baseline_method='bootstrap',
+                 random_state=None):
+        if reference_data is None and (z_stats is None or originality_model is None):
+            raise TypeError('Provide reference_data, or both z_stats and originality_model')
+        self.target_word = target_word
+        self.multi_target = multi_target
+        self.nlp = get_nlp(DEFAULT_MODEL, vectors_only=True) if nlp is None else nlp
+        self.batch_size = batch_size
+        self.baseline_method = baseline_method
+        self._target_vectors = {}
+        self._baselines = {}
+        self._baseline_errors = {}
+
+        warm_targets = ([] if target_word is None else [target_word]) if warm_targets is None else warm_targets
+        for target in warm_targets:
+            self._get_baselines(target, range(1, max_elaboration + 1))
+
+        if originality_model is None:
+            logger.info(msg_prefix + 'Fitting originality on %d reference responses', len(reference_data))
+            originality_model = fit_originality(reference_data.response, random_state=random_state)
+        self.originality_model = originality_model
+        if z_stats is None:
+            logger.info(msg_prefix + 'Scoring reference data')
+            reference_results = score_responses(reference_data, target_word, self.nlp, multi_target,
+                                                originality_model=originality_model, baseline_method=baseline_method)
+            subject_fluency = reference_results.groupby('ID', sort=False).fluency.first()
+            z_stats = {metric: (np.nanmean(reference_results[metric]), np.std(reference_results[metric]))
+                       for metric in RESPONSE_METRICS}
+            z_stats['fluency'] = (np.nanmean(subject_fluency), np.std(subject_fluency))
+        self.z_stats = z_stats
+
+    def _get_target_vector(self, target):
+        if target not in self._target_vectors:
+            self._target_vectors.update(embed_targets([target], self.nlp))
+        return self._target_vectors[target]
+
+    def _get_baselines(self, target, word_counts):
+        """Bootstrapped similarities for target, only reading or bootstrapping word counts not yet in memory"""
+        baselines = self._baselines.setdefault(target, {})
+        errors = self._baseline_errors.setdefault(target, {})
+        missing_counts = [k for k in pd.unique(np.asarray(word_counts, dtype=np.float64))
+                          if not np.isnan(k) and int(k) not in baselines]
+        if len(missing_counts) > 0:
+            new_baselines, new_errors = bootstrap_similarity(missing_counts, target, method=self.baseline_method,
+                                                             return_errors=True)
+            baselines.update(new_baselines)
+            errors.update(new_errors)
+        return baselines
+
+    def get_baselines(self, target, word_counts):
+        """Chance similarity baselines used to correct flexibility, with their errors
+
+        Arguments
+        ---------
+        target: str
+            target word
+        word_counts: list
+            word counts to get baselines for
+
+        Returns
+        -------
+        (dict, dict)
+            keys for each word count with values for average chance similarity, and for its error (see
+            flexibility_elaboration.bootstrap_similarity with return_errors=True)
+        """
+        baselines = self._get_baselines(target, word_counts)
+        errors = self._baseline_errors[target]
+        return ({k: baselines[k] for k in word_counts if k in baselines},
+                {k: errors.get(k, np.nan) for k in word_counts if k in baselines})
+
+    def score(self, data_by_response):
+        """Score a batch of responses with a single nlp.pipe pass and one matrix pass per metric
+
+        Arguments
+        ---------
+        data_by_response: pandas dataframe
+            one row per response with columns 'responseID', 'ID', and 'response' (and 'target_word' if multi_target)
+
+        Returns
+        -------
+        {
+            results_by_response: pandas dataframe (see calc_all_creativity)
+            results_by_subject: pandas dataframe (see calc_all_creativity)
+        }
+        """
+        if len(data_by_response) == 0:
+            raise ValueError('No responses to score')
+        responses = list(data_by_response.response)
+        records = preprocess_responses(responses, self.nlp, batch_size=self.batch_size)
+        results_df = pd.DataFrame({'responseID': data_by_response.responseID, 'ID': data_by_response.ID})
+        results_df['fluency'] = calc_fluency(data_by_response, self.nlp, records=records)
+
+        elaboration = records['elaboration']
+        target_words = list(data_by_response.target_word) if self.multi_target else \
+            [self.target_word] * len(responses)
+        target_codes, targets = pd.factorize(pd.Series(target_words))
+        raw_similarity = np.where(~np.isnan(elaboration),
+                                  target_similarities(records['lower_vectors'], target_codes,
+                                                      [self._get_target_vector(target) for target in targets]),
+                                  np.nan)
+        bootstrapped_sims = [self._get_baselines(target, elaboration[target_codes == code])
+                             for code, target in enumerate(targets)]
+        results_df['clean_response'] = records['clean_response']
+        results_df['elaboration'] = elaboration
+        results_df['flexibility'] = flexibility_from_similarity(raw_similarity, elaboration, target_codes, targets,
+                                                                bootstrapped_sims)
+        results_df['originality'] = score_originality(self.originality_model, responses)
+
+        add_z_scores(results_df, self.z_stats)
+        results_by_subject = summarize_by_subject(results_df, fluency_stats=self.z_stats['fluency'])
+        return {'results_by_response': results_df, 'results_by_subject': results_by_subject}
+
+    def score_participant(self, ID, responses, target_word=None):
+        """Score one participant's list of responses (see score). Raises a ValueError if there are no responses."""
+        responses = list(responses)
+        if len(responses) == 0:
+            raise ValueError('No responses to score for participant {!r}'.format(ID))
+        return self.score(_participant_frame(ID, responses, target_word if self.multi_target else None))
+
+
+def _participant_frame(ID, responses, target_word=None):
+    data = pd.DataFrame({'responseID': range(1, len(responses) + 1), 'ID': ID, 'response': list(responses)})
+    if target_word is not None:
+        data['target_word'] = target_word
+    return data
+
+
+class AsyncScoringService:
+    """asyncio front end for a ScoringService that micro-batches concurrent requests
+
+    Requests that arrive within max_wait seconds of each other (up to max_batch_size participants) are scored
+    together in one ScoringService.score call, which runs in a worker thread so the event loop stays responsive.
+
+    Arguments
+    ---------
+    service: ScoringService
+    max_batch_size: int, optional
+        most participants to score in one batch (default 64)
+    max_wait: float, optional
+        seconds to wait for more requests before scoring a batch (default 0.01)
+    """
+
+    def __init__(self, service, max_batch_size=64, max_wait=.01):
+        self.service = service
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = None
+        self._worker = None
+        self._batch = []
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._batch = []
+        self._worker = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop scoring. Requests that are queued or being scored fail with a RuntimeError."""
+        if self._worker is None:
+            return
+        worker, self._worker = self._worker, None
+        worker.cancel()
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+        pending = self._batch
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        _fail_batch(pending, RuntimeError('AsyncScoringService was stopped before this request was scored'))
+        self._batch = []
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def score_participant(self, ID, responses, target_word=None):
+        """Score one participant's responses, batched with other concurrent requests (see ScoringService.score)"""
+        if self._worker is None:
+            raise RuntimeError('Call start() (or use "async with") before scoring, and do not score after stop()')
+        responses = list(responses)
+        if len(responses) == 0:
+            raise ValueError('No responses to score for participant {!r}'.format(ID))
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((ID, responses, target_word, future))
+        return await future
+
+    async def _next_batch(self):
+        """Collect requests into self._batch, so stop() can fail them if it cancels the worker at any point"""
+        self._batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(self._batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                self._batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._next_batch()
+            try:
+                # score each request under its own key, so requests for the same participant don't pool responses
+                data = pd.concat([_participant_frame(key, responses,
+                                                     target_word if self.service.multi_target else None)
+                                  for key, (_, responses, target_word, _) in enumerate(self._batch)],
+                                 ignore_index=True)
+                data['responseID'] = range(1, len(data) + 1)
+                results = await loop.run_in_executor(None, self.service.score, data)
+                _split_results(self._batch, results)
+            except Exception as error:
+                _fail_batch(self._batch, error)
+            self._batch = []
+
+
+def _split_results(batch, results):
+    """Give each request in a batch its own rows of the batch's results"""
+    by_response = results['results_by_response']
+    by_subject = results['results_by_subject']
+    for key, (ID, _, _, future) in enumerate(batch):
+        if future.done():
+            continue
+        response_rows = by_response[by_response.ID == key].copy()
+        subject_rows = by_subject[by_subject.ID == key].copy()
+        response_rows['ID'] = ID
+        response_rows['responseID'] = range(1, len(response_rows) + 1)
+        subject_rows['ID'] = ID
+        future.set_result({'results_by_response': response_rows.reset_index(drop=True),
+                           'results_by_subject': subject_rows.reset_index(drop=True)})
+
+
+def _fail_batch(batch, error):
+    for *_, future in batch:
+        if not future.done():
+            future.set_exception(error)
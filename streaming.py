@@ -0,0 +1,188 @@
+import logging
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from calc_all_creativity import RESPONSE_METRICS, score_responses, add_z_scores, summarize_by_subject
+from originality import fit_originality
+from models import DEFAULT_MODEL, get_nlp
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+msg_prefix = '[STREAM] '
+
+
+def read_response_chunks(path, chunksize=10000):
+    """Read a by-response dataset (as created by transform_data_by_response.py) in chunks of rows
+
+    Arguments
+    ---------
+    path: str
+        CSV file, or Parquet file (ending in .parquet, requires pyarrow)
+    chunksize: int, optional
+        number of rows per chunk (default 10,000)
+
+    Yields
+    ------
+    pandas dataframe
+    """
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Reading Parquet files in chunks requires pyarrow: pip install pyarrow')
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            yield chunk
+
+
+def complete_subject_chunks(chunks, id_column='ID'):
+    """Re-chunk so that no subject's responses are split over two chunks.
+
+    Assumes each subject's responses are on consecutive rows, as transform_data_by_response.py creates them. The last
+    subject of each chunk is held back and prepended to the next chunk.
+    """
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        is_last = (chunk[id_column] == chunk[id_column].iloc[-1]).values
+        carry = chunk[is_last]
+        if not is_last.all():
+            yield chunk[~is_last]
+    if carry is not None and len(carry) > 0:
+        yield carry
+
+
+def sample_responses(chunks, sample_size, seed=None, response_column='response'):
+    """Draw a uniform random sample of responses from chunks in one pass (reservoir sampling)"""
+    rng = np.random.default_rng(seed)
+    sample = []
+    n_seen = 0
+    for chunk in chunks:
+        for response in chunk[response_column]:
+            if len(sample) < sample_size:
+                sample.append(response)
+            else:
+                replace_index = rng.integers(0, n_seen + 1)
+                if replace_index < sample_size:
+                    sample[replace_index] = response
+            n_seen += 1
+    return sample
+
+
+def new_running_stats():
+    return {'n': 0, 'mean': 0., 'm2': 0.}
+
+
+def update_running_stats(stats, values):
+    """Add values (ignoring NaN) to running count, mean, and sum of squared deviations (Chan et al. merge)"""
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return stats
+    n_new, mean_new = len(values), values.mean()
+    m2_new = np.sum((values - mean_new) ** 2)
+    n_total = stats['n'] + n_new
+    delta = mean_new - stats['mean']
+    stats['mean'] += delta * n_new / n_total
+    stats['m2'] += m2_new + delta ** 2 * stats['n'] * n_new / n_total
+    stats['n'] = n_total
+    return stats
+
+
+def running_mean_std(stats):
+    """(mean, population standard deviation) from running stats, matching z_score in calc_all_creativity.py"""
+    return stats['mean'], np.sqrt(stats['m2'] / stats['n']) if stats['n'] > 0 else np.nan
+
+
+def calc_all_creativity_streaming(input_path, response_output_path, subject_output_path, target_word=None, nlp=None,
+                                  output_prefix='', multi_target=False, chunksize=10000, originality_sample_size=20000,
+                                  originality_model=None, seed=None, n_jobs=1, progress_callback=None):
+    """Calculate all creativity metrics for a dataset that does not fit in memory, one chunk at a time.
+
+    The input file is read three times. First, a random sample of responses is drawn to fit the originality clusters
+    (unless an originality_model is given). Second, raw metrics are calculated chunk by chunk and written to a
+    temporary file, while running means and variances are kept for z scoring. Third, the raw metrics are read back,
+    z scored with the full-dataset statistics, and written out together with the by-subject summary. Memory use is
+    bounded by the chunk size and the originality sample size.
+
+    Each subject's responses must be on consecutive rows of the input file, as transform_data_by_response.py creates
+    them, because fluency needs all of a subject's responses at once.
+
+    Arguments
+    ---------
+    input_path: str
+        CSV or Parquet file with one row per response (columns 'responseID', 'ID', 'response', and 'target_word' if
+        multi_target is True)
+    response_output_path: str
+        CSV file to write the by-response results to
+    subject_output_path: str
+        CSV file to write the by-subject results to
+    target_word, nlp, output_prefix, multi_target, n_jobs:
+        see calc_all_creativity
+    chunksize: int, optional
+        number of rows to read at a time (default 10,000)
+    originality_sample_size: int, optional
+        number of responses to fit the originality clusters on (default 20,000)
+    originality_model: dict, optional
+        output from originality.fit_originality. If given, no sample is drawn and responses are scored against it.
+    seed: int, optional
+        seed for drawing the originality sample
+    progress_callback: function, optional
+        see calc_all_creativity. The 'scoring' stage reports the number of responses scored so far, with total None
+        because the number of responses is not known until the file has been read; the timing report is logged at the
+        end.
+
+    Returns
+    -------
+    dict
+        (mean, standard deviation) used to z score each metric, with key 'fluency' for subject fluency
+    """
+    if (target_word is None) & (not multi_target):
+        raise TypeError(
+            "If the task has a single target word, provide a target_word argument. If there are multiple target words, "
+            + "set the multi_target argument to True and make sure the input has a 'target_word' column")
+    if nlp is None:
+        nlp = get_nlp(DEFAULT_MODEL, vectors_only=True)
+    instrumentation.start_report(progress_callback)
+
+    if originality_model is None:
+        with instrumentation.stage('originality fit'):
+            logger.info(msg_prefix + 'Fitting originality on a sample of %d responses', originality_sample_size)
+            originality_model = fit_originality(
+                sample_responses(read_response_chunks(input_path, chunksize), originality_sample_size, seed))
+
+    stats = {metric: new_running_stats() for metric in RESPONSE_METRICS + ['fluency']}
+    output_dir = os.path.dirname(os.path.abspath(response_output_path))
+    raw_file, raw_path = tempfile.mkstemp(suffix='.csv', dir=output_dir)
+    os.close(raw_file)
+    try:
+        n_responses = 0
+        for i, chunk in enumerate(complete_subject_chunks(read_response_chunks(input_path, chunksize))):
+            results_df = score_responses(chunk, target_word, nlp, multi_target, n_jobs, originality_model)
+            for metric in RESPONSE_METRICS:
+                update_running_stats(stats[metric], results_df[metric])
+            update_running_stats(stats['fluency'], results_df.groupby('ID', sort=False).fluency.first())
+            results_df.to_csv(raw_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            n_responses += len(results_df)
+            logger.info(msg_prefix + 'Scored %d responses', n_responses)
+            instrumentation.progress('scoring', n_responses, None)
+
+        z_stats = {metric: running_mean_std(stats[metric]) for metric in stats}
+        logger.info(msg_prefix + 'Z-scoring and writing results')
+        raw_chunks = read_response_chunks(raw_path, chunksize) if n_responses > 0 else []
+        for i, results_df in enumerate(complete_subject_chunks(raw_chunks)):
+            with instrumentation.stage('z scores and subject summary'):
+                add_z_scores(results_df, z_stats)
+                results_by_subject = summarize_by_subject(results_df, output_prefix, z_stats['fluency'])
+            results_df.to_csv(response_output_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            results_by_subject.to_csv(subject_output_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    finally:
+        os.remove(raw_path)
+
+    logger.info(msg_prefix + 'Done calculating all creativity metrics: %s', instrumentation.get_report())
+    return z_stats
@@ -0,0 +1,21 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+from chance_similarity import chance_similarities  # noqa: E402
+
+
+def _vocab_vectors(n_words=500, width=20, seed=0):
+    """Random vector table in the format of extract_vocab_vectors, with some words sharing a row"""
+    rng = np.random.default_rng(seed)
+    data = rng.normal(size=(n_words // 2, width)).astype(np.float32)
+    return {'data': data, 'rows': rng.integers(0, len(data), n_words).astype(np.int32)}
+
+
+def test_seeded_baseline_only_depends_on_seed_and_word_count():
+    vocab_vectors = _vocab_vectors()
+    target = np.random.default_rng(1).normal(size=20).astype(np.float32)
+    alone = chance_similarities(vocab_vectors, target, [3], n_samples=2000, seed=5)
+    for word_counts in ([1, 2, 3], [3, 4], [3, 10], [1, 3, 7, 8, 20]):
+        together = chance_similarities(vocab_vectors, target, word_counts, n_samples=2000, seed=5)
+        assert together[3] == alone[3]
+    assert chance_similarities(vocab_vectors, target, [3], n_samples=2000, seed=6)[3] != alone[3]
@@ -0,0 +1,63 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('spacy')
+import baseline_store  # noqa: E402
+import models  # noqa: E402
+from benchmark import make_synthetic_nlp  # noqa: E402
+from flexibility_elaboration import (bootstrap_similarity, calc_flexibility_and_elaboration,  # noqa: E402
+                                     calc_flexibility_and_elaboration_multi_target, calc_similarity)
+
+
+@pytest.fixture
+def synthetic_nlp(tmp_path, monkeypatch):
+    """Small random vector table standing in for both Spacy models, with baselines stored in a fresh store"""
+    nlp, words = make_synthetic_nlp(vocab_size=300, vector_width=20)
+    monkeypatch.setenv(baseline_store.STORE_PATH_ENV, str(tmp_path / 'baselines.sqlite'))
+    models.register_nlp(models.DEFAULT_MODEL, nlp)
+    models.register_nlp(models.BASELINE_MODEL, nlp)
+    yield nlp, words
+    models.clear_models()
+
+
+def _random_responses(words, n_responses=200, seed=0):
+    """Responses of a few random words, some with a stop word or punctuation, and some without any word vector"""
+    rng = np.random.default_rng(seed)
+    responses = []
+    for i in range(n_responses):
+        response = [str(word) for word in rng.choice(words, size=rng.integers(1, 6))]
+        if i % 3 == 0:
+            response.insert(0, 'the')
+        if i % 7 == 0:
+            response = ['...']
+        responses.append(' '.join(response) + ('!' if i % 5 == 0 else ''))
+    return responses
+
+
+def _per_response_flexibility(target_words, nlp, result):
+    """Flexibility the way it was calculated before vectorizing: Spacy similarity per response minus the baseline"""
+    flexibility = []
+    for clean_response, elaboration, target in zip(result.clean_response, result.elaboration, target_words):
+        # newer pandas versions store missing clean responses as NaN instead of None
+        similarity = calc_similarity(clean_response if isinstance(clean_response, str) else None, target, nlp)
+        if similarity is None:
+            flexibility.append(np.nan)
+        else:
+            flexibility.append(1 - abs(similarity - bootstrap_similarity([elaboration], target)[elaboration]))
+    return np.array(flexibility)
+
+
+def test_flexibility_matches_per_response_similarity(synthetic_nlp):
+    nlp, words = synthetic_nlp
+    responses = _random_responses(words[2:])
+    target_words = [words[i % 2] for i in range(len(responses))]
+
+    result = calc_flexibility_and_elaboration(responses, words[0], nlp)
+    expected = _per_response_flexibility([words[0]] * len(responses), nlp, result)
+    np.testing.assert_allclose(result.flexibility, expected, atol=1e-7)
+
+    result = calc_flexibility_and_elaboration_multi_target(responses, target_words, nlp)
+    expected = _per_response_flexibility(target_words, nlp, result)
+    np.testing.assert_allclose(result.flexibility, expected, atol=1e-7)
+    assert np.isnan(result.flexibility[0]) and np.isnan(result.elaboration[0])
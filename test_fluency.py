@@ -0,0 +1,39 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('spacy')
+from fluency import (calc_fluency_from_features, merge_similar_responses, merge_similar_responses_indexed,  # noqa: E402
+                     pooled_fluency)
+
+
+def _clustered_vectors(seed, n_clusters=5, n_responses=30, width=20, noise=.4):
+    """Random responses around a few cluster centers, with many pairs near the .8 merge threshold"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, width))
+    vectors = centers[rng.integers(0, n_clusters, n_responses)] + rng.normal(scale=noise, size=(n_responses, width))
+    return vectors.astype(np.float32), rng.integers(1, 5, n_responses)
+
+
+def test_blocked_merge_matches_dense_merge():
+    for seed in range(300):
+        vectors, word_counts = _clustered_vectors(seed)
+        dense = merge_similar_responses(vectors, word_counts, include_last=True)
+        assert merge_similar_responses_indexed(vectors, word_counts, method='blocked', block_size=7) == dense
+
+
+def test_lsh_merge_finds_near_identical_responses():
+    vectors, word_counts = _clustered_vectors(0, n_clusters=1, n_responses=200, noise=.01)
+    assert pooled_fluency(vectors, word_counts, method='lsh', max_bucket_size=16) == 1
+
+
+def test_last_response_counts_when_included():
+    vectors = np.eye(3, dtype=np.float32)
+    assert merge_similar_responses(vectors, [1, 1, 1]) == [[0], [1]]
+    assert merge_similar_responses(vectors, [1, 1, 1], include_last=True) == [[0], [1], [2]]
+    assert pooled_fluency(vectors, [1, 1, 1]) == 3
+
+
+def test_fluency_from_features_skips_responses_without_id():
+    features = {'vectors': np.eye(6, dtype=np.float32), 'elaboration': np.ones(6),
+                'participant_codes': np.array([0, 0, -1, -1, 1, 1]), 'participants': ['a', 'b']}
+    assert list(calc_fluency_from_features(features)) == [1, 1]
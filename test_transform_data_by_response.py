@@ -0,0 +1,24 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+from transform_data_by_response import POSSIBLE_DELIMITERS, parse_response_series, parse_responses  # noqa: E402
+
+
+def _random_texts(seed, n_texts=3000, max_length=30):
+    """Random strings of letters, spaces, and every possible delimiter, so delimiter counts often tie"""
+    rng = np.random.default_rng(seed)
+    characters = np.array(list('ab ') + POSSIBLE_DELIMITERS)
+    return pd.Series([''.join(rng.choice(characters, size=rng.integers(0, max_length))) for _ in range(n_texts)])
+
+
+@pytest.mark.parametrize('force_default', [False, True])
+@pytest.mark.parametrize('default_delimiter', POSSIBLE_DELIMITERS)
+def test_series_parsing_matches_parse_responses(default_delimiter, force_default):
+    texts = _random_texts(0)
+    parsed = parse_response_series(texts, default_delimiter, force_default)
+    assert list(parsed.index) == list(texts.index)
+    for text, responses in zip(texts, parsed):
+        # splitting keeps the empty strings between repeated delimiters, which parse_responses leaves out
+        assert [response for response in responses if response != ''] == \
+            parse_responses(text, default_delimiter, force_default)
@@ -2,6 +2,10 @@ import pandas as pd
 import numpy as np
 import re
 
+POSSIBLE_DELIMITERS = ['/', '\\', '\n', ',', '|']
+# matches spaces around possible delimiters (to remove empty responses)
+DELIMITER_SPACE_REGEX = r'\s*([' + ''.join(POSSIBLE_DELIMITERS) + r'])\s*'
+
 
 def parse_responses(text: str, default_delimiter='\n', force_default=False) -> list:
     """Find most common punctuation in string of responses,
@@ -9,14 +13,13 @@ def parse_responses(text: str, default_delimiter='\n', force_default=False) -> l
 
     if pd.isnull(text):
         return []
-    possible_delimiters = ['/', '\\', '\n', ',', '|']
+    possible_delimiters = POSSIBLE_DELIMITERS
 
     # remove spaces around possible delimiters (to remove empty responses)
-    regex = r'\s*([' + ''.join(possible_delimiters) + r'])\s*'
-    clean_text = re.sub(regex, r'\1', text)
+    clean_text = re.sub(DELIMITER_SPACE_REGEX, r'\1', text)
 
     # find most common possible delimiter
-    default_delimiter_count = len(re.findall(default_delimiter, clean_text))
+    default_delimiter_count = len(re.findall(re.escape(default_delimiter), clean_text))
     max_count = 0
     max_delimiter = ''
     for d in possible_delimiters:
@@ -31,31 +34,91 @@ def parse_responses(text: str, default_delimiter='\n', force_default=False) -> l
                       else max_delimiter)
 
     # split on text delimiter found
-    split_pattern = r'[^' + text_delimiter + r']+'
+    split_pattern = r'[^' + re.escape(text_delimiter) + r']+'
     responses = re.findall(split_pattern, clean_text)
 
     return responses
 
 
+def parse_response_series(texts, default_delimiter='\n', force_default=False):
+    """Vectorized parse_responses: split each string in a series of responses on its most common delimiter
+
+    Arguments
+    ---------
+    texts: pandas series
+        strings of responses
+    default_delimiter: str, optional
+        delimiter to use unless another one is more common in a string (default newline)
+    force_default: bool, optional
+        always split on default_delimiter (default False)
+
+    Returns
+    -------
+    pandas series
+        list of responses for each string (same index as texts)
+    """
+    if len(texts) == 0:
+        return pd.Series([], index=texts.index, dtype=object)
+    clean_texts = texts.str.replace(DELIMITER_SPACE_REGEX, r'\1', regex=True)
+    other_delimiters = [d for d in POSSIBLE_DELIMITERS if d != default_delimiter]
+    # as in parse_responses, the default delimiter wins ties, and otherwise the first most common delimiter is used
+    other_counts = np.column_stack([clean_texts.str.count(re.escape(d)).values for d in other_delimiters])
+    use_default = np.full(len(texts), True) if force_default else \
+        clean_texts.str.count(re.escape(default_delimiter)).values >= other_counts.max(axis=1)
+    text_delimiters = np.where(use_default, default_delimiter,
+                               np.array(other_delimiters, dtype=object)[other_counts.argmax(axis=1)])
+    # an escaped pattern splits on the literal delimiter (without the regex keyword, which needs pandas 1.4)
+    return pd.concat([clean_texts[text_delimiters == delimiter].str.split(re.escape(delimiter))
+                      for delimiter in pd.unique(text_delimiters)]).reindex(texts.index)
+
+
+def _explode_responses(raw_data, delimiter, id_column, response_column):
+    """One row per response (columns ID, response_num, response) for the string responses in raw_data"""
+    raw_data = raw_data.loc[raw_data[response_column].map(lambda r: isinstance(r, str)), [id_column, response_column]]
+    raw_data = raw_data.reset_index(drop=True)
+    responses = parse_response_series(raw_data[response_column], default_delimiter=delimiter)
+    response_data = pd.DataFrame({'ID': raw_data[id_column], 'response': responses}).explode('response')
+    # splitting leaves empty strings where delimiters were repeated or at the ends
+    response_data = response_data[response_data.response.notna() & (response_data.response != '')]
+    response_data.insert(1, 'response_num', response_data.groupby(level=0).cumcount() + 1)
+    return response_data.reset_index(drop=True)
+
+
 def transform_data_by_response(raw_data, delimiter='/', id_column='ID',
-                               response_column='response'):
-    subject_ids = raw_data[id_column]
-    raw_data = raw_data.set_index(id_column, drop=False)
-    responses_by_subject = {}
-    response_data = pd.DataFrame(columns=['ID', 'response_num', 'response'])
-    for subject in subject_ids:
-        response = raw_data.at[subject, response_column]
-        if not isinstance(response, str):
-            continue
-        responses_by_subject[subject] = parse_responses(response,
-                                                        default_delimiter=delimiter)
-        nrow = len(responses_by_subject[subject])
-        sub_df = pd.DataFrame(data={'ID': [subject] * nrow,
-                                    'response_num': range(1, nrow + 1),
-                                    'response': responses_by_subject[subject]})
-        response_data = response_data.append(sub_df, ignore_index=True)
-
-    response_data['responseID'] = np.random.choice(range(1, len(response_data) + 1),
-                                                   size=len(response_data),
-                                                   replace=False)
+                               response_column='response', random_state=None, shuffle_ids=True):
+    """Transform data with one row per subject (all responses in one string) to one row per response
+
+    Arguments
+    ---------
+    raw_data: pandas dataframe or iterator of pandas dataframes
+        one row per subject. An iterator of chunks (e.g. from pd.read_csv(..., chunksize=...)) is parsed chunk by
+        chunk.
+    delimiter: str, optional
+        delimiter between responses, unless another one is more common in a subject's responses (default '/')
+    id_column: str, optional
+        column with subject IDs (default 'ID')
+    response_column: str, optional
+        column with responses (default 'response')
+    random_state: int, optional
+        seed for the random responseID permutation, for reproducible responseIDs
+    shuffle_ids: bool, optional
+        assign responseIDs in random order. If False, responses are numbered in order. (default True)
+
+    Returns
+    -------
+    pandas dataframe
+        one row per response with columns ID, response_num, response, and responseID (also the index)
+    """
+    chunks = [raw_data] if isinstance(raw_data, pd.DataFrame) else raw_data
+    parsed_chunks = [_explode_responses(chunk, delimiter, id_column, response_column) for chunk in chunks]
+    response_data = pd.concat(parsed_chunks, ignore_index=True) if len(parsed_chunks) > 0 else \
+        pd.DataFrame(columns=['ID', 'response_num', 'response'])
+
+    n_responses = len(response_data)
+    if not shuffle_ids:
+        response_data['responseID'] = np.arange(1, n_responses + 1)
+    elif random_state is None:
+        response_data['responseID'] = np.random.choice(range(1, n_responses + 1), size=n_responses, replace=False)
+    else:
+        response_data['responseID'] = np.random.default_rng(random_state).permutation(n_responses) + 1
     return response_data.set_index('responseID', drop=False)